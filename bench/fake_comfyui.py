@@ -0,0 +1,184 @@
+import io
+import json
+import uuid
+import struct
+import asyncio
+import argparse
+from aiohttp import web
+from loguru import logger
+from PIL import Image
+
+
+def make_image(format="PNG", size=(64, 64), color=(28, 131, 225)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+class FakeComfyUI:
+    """
+    A minimal comfyui server for load tests: /prompt, /queue, /interrupt, /history, /view, /upload/image,
+    /object_info and /ws. Prompts run one at a time, every node sends progress and preview frames like a
+    sampler would.
+    """
+    def __init__(self, steps=5, step_delay=0.01, images=2) -> None:
+        self.steps = steps
+        self.step_delay = step_delay
+        self.images = images
+        # client_id -> websocket
+        self.sockets = {}
+        self.history = {}
+        self.prompt_queue = asyncio.Queue()
+        # prompt ids deleted from the queue, and the running prompt id to interrupt
+        self.deleted = set()
+        self.interrupted = None
+        self.preview_frame = struct.pack(">II", 1, 1) + make_image("JPEG", (32, 32))
+        self.output_image = make_image("PNG")
+
+    async def send(self, client_id, message):
+        ws = self.sockets.get(client_id)
+        if ws is None or ws.closed:
+            return
+        if isinstance(message, bytes):
+            await ws.send_bytes(message)
+        else:
+            await ws.send_str(json.dumps(message))
+
+    def status_message(self, sid=None):
+        data = {"status": {"exec_info": {"queue_remaining": self.prompt_queue.qsize()}}}
+        if sid is not None:
+            data["sid"] = sid
+        return {"type": "status", "data": data}
+
+    async def execute_loop(self):
+        while True:
+            prompt_id, client_id, prompt = await self.prompt_queue.get()
+            if prompt_id in self.deleted:
+                self.deleted.discard(prompt_id)
+                continue
+            outputs = await self.execute(prompt_id, client_id, prompt)
+            if outputs is not None:
+                self.history[prompt_id] = {"prompt": prompt, "outputs": outputs}
+                await self.send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+            else:
+                await self.send(client_id, {"type": "execution_interrupted", "data": {"prompt_id": prompt_id}})
+            self.interrupted = None
+            for sid in list(self.sockets):
+                await self.send(sid, self.status_message())
+
+    async def execute(self, prompt_id, client_id, prompt):
+        # outputs by node id, None when the prompt was interrupted
+        await self.send(client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id}})
+        await self.send(client_id, {"type": "execution_cached", "data": {"nodes": [], "prompt_id": prompt_id}})
+        # SaveImage and PreviewImage nodes are outputs, or the last node when there is none
+        output_nodes = [node_id for node_id in prompt if prompt[node_id].get("class_type") in ("SaveImage", "PreviewImage")]
+        if not output_nodes:
+            output_nodes = list(prompt)[-1:]
+        outputs = {}
+        for node_id in prompt:
+            await self.send(client_id, {"type": "executing", "data": {"node": node_id, "prompt_id": prompt_id}})
+            for step in range(self.steps):
+                if self.interrupted == prompt_id:
+                    return None
+                await self.send(client_id, {"type": "progress", "data": {"value": step + 1, "max": self.steps, "prompt_id": prompt_id, "node": node_id}})
+                await self.send(client_id, self.preview_frame)
+                await asyncio.sleep(self.step_delay)
+            if node_id in output_nodes:
+                images = [{"filename": f"{prompt_id}_{node_id}_{i}.png", "subfolder": "", "type": "output"} for i in range(self.images)]
+                outputs[node_id] = {"images": images}
+                await self.send(client_id, {"type": "executed", "data": {"node": node_id, "output": {"images": images}, "prompt_id": prompt_id}})
+        return outputs
+
+    async def websocket_handler(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get("clientId") or str(uuid.uuid4())
+        self.sockets[client_id] = ws
+        await ws.send_str(json.dumps(self.status_message(sid=client_id)))
+        async for _ in ws:
+            pass
+        self.sockets.pop(client_id, None)
+        return ws
+
+    async def get_prompt(self, request):
+        return web.json_response({"exec_info": {"queue_remaining": self.prompt_queue.qsize()}})
+
+    async def post_prompt(self, request):
+        data = await request.json()
+        prompt_id = str(uuid.uuid4())
+        await self.prompt_queue.put((prompt_id, data["client_id"], data["prompt"]))
+        return web.json_response({"prompt_id": prompt_id, "number": self.prompt_queue.qsize(), "node_errors": {}})
+
+    async def post_queue(self, request):
+        data = await request.json()
+        self.deleted.update(data.get("delete", []))
+        return web.json_response({})
+
+    async def post_interrupt(self, request):
+        data = await request.json()
+        self.interrupted = data.get("prompt_id")
+        return web.json_response({})
+
+    async def get_history(self, request):
+        prompt_id = request.match_info["prompt_id"]
+        if prompt_id not in self.history:
+            return web.json_response({})
+        return web.json_response({prompt_id: self.history[prompt_id]})
+
+    async def view(self, request):
+        return web.Response(body=self.output_image, content_type="image/png")
+
+    async def upload_image(self, request):
+        reader = await request.multipart()
+        name = None
+        async for part in reader:
+            if part.name == "image":
+                name = part.filename
+                while await part.read_chunk():
+                    pass
+        return web.json_response({"name": name, "subfolder": "", "type": "input"})
+
+    async def object_info(self, request):
+        return web.json_response({
+            "KSampler": {"input": {"required": {"seed": ["INT", {"min": 0, "max": 0xffffffffffffffff}]}}, "output_node": False},
+            "SaveImage": {"input": {"required": {"filename_prefix": ["STRING", {"default": "ComfyUI"}]}}, "output_node": True},
+        })
+
+    def make_app(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.add_routes([
+            web.get("/ws", self.websocket_handler),
+            web.get("/prompt", self.get_prompt),
+            web.post("/prompt", self.post_prompt),
+            web.post("/queue", self.post_queue),
+            web.post("/interrupt", self.post_interrupt),
+            web.get("/history/{prompt_id}", self.get_history),
+            web.get("/view", self.view),
+            web.post("/upload/image", self.upload_image),
+            web.get("/object_info", self.object_info),
+        ])
+
+        async def start_execute_loop(app):
+            app["execute_loop"] = asyncio.create_task(self.execute_loop())
+        app.on_startup.append(start_execute_loop)
+        return app
+
+
+async def start_fake_comfyui(fake, host="127.0.0.1", port=8188):
+    runner = web.AppRunner(fake.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"Fake comfyui listening on http://{host}:{port}")
+    return runner
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fake comfyui server')
+    parser.add_argument('--port', type=int, default=8188, help='listen port')
+    parser.add_argument('--steps', type=int, default=20, help='sampler steps per node')
+    parser.add_argument('--step-delay', type=float, default=0.05, help='seconds per sampler step')
+    args = parser.parse_args()
+
+    fake = FakeComfyUI(steps=args.steps, step_delay=args.step_delay)
+    web.run_app(fake.make_app(), host="127.0.0.1", port=args.port)
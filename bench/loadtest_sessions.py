@@ -0,0 +1,94 @@
+"""
+Load test of per-prompt event routing: N simulated sessions generate at the same time through one
+ComfyClient against a local fake comfyui, every session must see only the events of its own prompt.
+
+usage: python -m bench.loadtest_sessions --sessions 32 --rounds 3
+"""
+import time
+import queue
+import asyncio
+import argparse
+import threading
+from loguru import logger
+from modules.comfyclient import ComfyClient
+from bench.fake_comfyui import FakeComfyUI, start_fake_comfyui
+
+
+def run_fake_comfyui(fake, port):
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(start_fake_comfyui(fake, port=port))
+    threading.Thread(target=loop.run_forever, name="fake-comfyui", daemon=True).start()
+
+
+def run_session(comfy_client, session_id, rounds, timeout, results):
+    for round_index in range(rounds):
+        node_id = f"{session_id}-{round_index}"
+        prompt = {node_id: {"class_type": "SaveImage", "inputs": {}}}
+        progress_queue = queue.Queue()
+        start = time.monotonic()
+        prompt_id = comfy_client.gen_images(prompt, progress_queue)
+        events = 0
+        foreign = 0
+        outputs = None
+        while True:
+            try:
+                event = progress_queue.get(timeout=timeout)
+            except queue.Empty:
+                logger.error(f"Session {session_id} timeout, prompt {prompt_id}")
+                results.append({"session": session_id, "ok": False, "events": events, "foreign": foreign, "latency": None})
+                return
+            events += 1
+            event_type = event['type']
+            if event_type == 'executing' and event['data'] is not None and event['data'] != node_id:
+                foreign += 1
+            elif event_type == 'executed':
+                if event['data']['node'] != node_id:
+                    foreign += 1
+                outputs = event['data']['output']
+            elif event_type == 'executing' and event['data'] is None:
+                break
+        ok = foreign == 0 and outputs is not None and outputs['images'][0]['filename'].startswith(prompt_id)
+        results.append({"session": session_id, "ok": ok, "events": events, "foreign": foreign, "latency": time.monotonic() - start})
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test of comfyui event routing')
+    parser.add_argument('--sessions', type=int, default=16, help='concurrent simulated sessions')
+    parser.add_argument('--rounds', type=int, default=2, help='generations per session')
+    parser.add_argument('--steps', type=int, default=5, help='sampler steps per prompt')
+    parser.add_argument('--port', type=int, default=8189, help='fake comfyui port')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for an event')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(lambda msg: print(msg, end=""), level="WARNING")
+
+    fake = FakeComfyUI(steps=args.steps, step_delay=0.001)
+    run_fake_comfyui(fake, args.port)
+    comfy_client = ComfyClient(server_addr=f"http://127.0.0.1:{args.port}")
+
+    results = []
+    start = time.monotonic()
+    sessions = [threading.Thread(target=run_session, args=(comfy_client, i, args.rounds, args.timeout, results))
+                for i in range(args.sessions)]
+    for session in sessions:
+        session.start()
+    for session in sessions:
+        session.join()
+    elapsed = time.monotonic() - start
+
+    failed = [result for result in results if not result['ok']]
+    latencies = [result['latency'] for result in results if result['latency'] is not None]
+    print(f"sessions: {args.sessions}, prompts: {len(results)}, failed: {len(failed)}, elapsed: {elapsed:.2f}s")
+    print(f"foreign events: {sum(result['foreign'] for result in results)}, events: {sum(result['events'] for result in results)}")
+    if latencies:
+        print(f"latency p50: {percentile(latencies, 0.5):.3f}s, p95: {percentile(latencies, 0.95):.3f}s")
+    print(f"dispatcher: {comfy_client.websocket.dispatcher.stats()}")
+    print(f"http pool: {comfy_client.pool_stats()}")
+    print(f"threads: {threading.active_count()}, websockets: {len(fake.sockets)}")
+    exit(1 if failed else 0)
@@ -0,0 +1,110 @@
+"""
+Throughput of concurrent reads and writes on the app database: reader threads list a page of apps,
+writer threads update app urls like the Workspace page does. Runs once on default sqlite settings
+with a commit per write, and once with the WAL pragmas, a connection pool and the single writer.
+
+usage: python -m bench.sqlite_throughput --readers 8 --writers 8 --seconds 5
+"""
+import os
+import time
+import tempfile
+import argparse
+import threading
+from loguru import logger
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
+from modules.storage import tune_sqlite_engine, SqliteWriter
+
+LIST_SQL = text('SELECT id, name, description, status, updated_at FROM comfyflow_apps WHERE id<:before_id ORDER BY id DESC LIMIT 21;')
+UPDATE_SQL = text('UPDATE comfyflow_apps SET url=:url, updated_at=datetime("now") WHERE name=:name;')
+
+
+def create_db(path, apps):
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE comfyflow_apps (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, description TEXT, app_conf TEXT, url TEXT, status TEXT, updated_at TEXT);'))
+        conn.execute(text('INSERT INTO comfyflow_apps (name, description, app_conf, url, status) VALUES (:name, :description, :app_conf, "", "Installed");'),
+                     [dict(name=f"app{i}", description="d" * 160, app_conf="{}" * 2000) for i in range(apps)])
+    engine.dispose()
+
+
+def run(engine, write, readers, writers, seconds, apps):
+    counts = {'reads': 0, 'writes': 0, 'locked': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def count(key):
+        with lock:
+            counts[key] += 1
+
+    def read_loop(index):
+        while time.monotonic() < deadline:
+            try:
+                with engine.connect() as conn:
+                    conn.execute(LIST_SQL, dict(before_id=apps - index)).fetchall()
+                count('reads')
+            except Exception as e:
+                count('locked' if 'locked' in str(e) else 'errors')
+
+    def write_loop(index):
+        n = 0
+        while time.monotonic() < deadline:
+            n += 1
+            try:
+                write(dict(url=f"http://{index}:{n}", name=f"app{(index * 31 + n) % apps}"))
+                count('writes')
+            except Exception as e:
+                count('locked' if 'locked' in str(e) else 'errors')
+
+    threads = [threading.Thread(target=read_loop, args=(i,)) for i in range(readers)]
+    threads += [threading.Thread(target=write_loop, args=(i,)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent read/write throughput of the app database')
+    parser.add_argument('--readers', type=int, default=8, help='reader threads')
+    parser.add_argument('--writers', type=int, default=8, help='writer threads')
+    parser.add_argument('--seconds', type=float, default=5, help='seconds per run')
+    parser.add_argument('--apps', type=int, default=500, help='apps in the table')
+    parser.add_argument('--pool-size', type=int, default=5, help='connection pool size of the tuned run')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(lambda msg: print(msg, end=""), level="WARNING")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'default.db')
+        create_db(path, args.apps)
+        # sqlalchemy 1.4 defaults of a file database, a new connection per use, rollback journal
+        engine = create_engine(f"sqlite:///{path}")
+
+        def write_default(params):
+            with engine.begin() as conn:
+                conn.execute(UPDATE_SQL, params)
+
+        default = run(engine, write_default, args.readers, args.writers, args.seconds, args.apps)
+        engine.dispose()
+
+        path = os.path.join(tmp, 'tuned.db')
+        create_db(path, args.apps)
+        engine = create_engine(f"sqlite:///{path}", poolclass=QueuePool, pool_size=args.pool_size,
+                               max_overflow=args.pool_size * 2, connect_args={'check_same_thread': False})
+        tune_sqlite_engine(engine)
+        writer = SqliteWriter(engine)
+        tuned = run(engine, lambda params: writer.execute(UPDATE_SQL, params), args.readers, args.writers,
+                    args.seconds, args.apps)
+        engine.dispose()
+
+    for name, counts in (('default', default), ('tuned', tuned)):
+        print(f"{name:8} reads/s: {counts['reads'] / args.seconds:9.1f}, writes/s: {counts['writes'] / args.seconds:8.1f}, "
+              f"locked: {counts['locked']}, errors: {counts['errors']}")
+    print(f"writer: {writer.writes} writes in {writer.commits} commits")
+
+
+if __name__ == '__main__':
+    main()
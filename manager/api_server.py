@@ -0,0 +1,312 @@
+"""
+Headless api to run installed apps without streamlit, every request maps its json params onto the
+prompt of the app the same way the Generate button does.
+
+    python -m manager.api_server --port 8180
+
+POST /apps/{id}/run         {"params": {"<input name>": value}}, returns {"job_id": ...}
+GET  /jobs/{job_id}         status and outputs of the job
+GET  /jobs/{job_id}/events  progress of the job as server-sent events, until it finishes
+
+UPLOADIMAGE and UPLOADVIDEO params take {"name": "cat.png", "data": "<base64>"}. When COMFYFLOW_API_TOKEN
+is set, requests need an "Authorization: Bearer <token>" header. It holds one token, or comma separated
+"<user>:<token>" entries, jobs are queued fairly per user of the token.
+"""
+import os
+import io
+import ipaddress
+import json
+import base64
+import asyncio
+import argparse
+from aiohttp import web
+from loguru import logger
+
+from modules import AppStatus, create_comfy_backends, create_job_manager, create_upload_manager
+from modules.comfyflow import Comfyflow
+from modules.jobs import JobStatus, JobQueueFullError
+from modules.template import TemplateCache
+from modules.workspace_model import WorkspaceModel
+
+# events streamed to api clients, previews are left out
+API_EVENTS = ('job', 'status', 'execution_start', 'execution_cached', 'executing', 'progress', 'executed',
+              'execution_error', 'execution_interrupted')
+
+
+class ParamError(Exception):
+    pass
+
+
+def parse_tokens(text):
+    # "<token>" or "<user>:<token>,<user>:<token>" -> {token: user}, a bare token belongs to user "api"
+    tokens = {}
+    for entry in (text or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        user, _, token = entry.rpartition(':')
+        tokens[token] = user or 'api'
+    return tokens
+
+
+class ApiUpload(io.BytesIO):
+    # an input file posted as base64, quacks like a streamlit UploadedFile for UploadManager
+    def __init__(self, name, data) -> None:
+        super().__init__(data)
+        self.name = name
+        self.file_id = None
+
+
+def parse_params(app_json, values):
+    """
+    values: {"<input name>": value} of a request
+    return: params {node_id: {param_item: value}} like Comfyflow.collect_params, and the uploads
+            [(node_id, param_item, subfolder, ApiUpload)] still to be sent to comfyui
+    """
+    params = {}
+    uploads = []
+    known = set()
+    for node_id in app_json['inputs']:
+        node_inputs = app_json['inputs'][node_id]['inputs']
+        for param_item in node_inputs:
+            param_node = node_inputs[param_item]
+            param_type = param_node['type']
+            param_name = param_node['name']
+            known.add(param_name)
+            if param_name not in values:
+                if param_type in ('UPLOADIMAGE', 'UPLOADVIDEO'):
+                    raise ParamError(f"Missing input file {param_name}")
+                elif param_type == 'SELECT':
+                    params.setdefault(node_id, {})[param_item] = param_node.get('default', param_node['options'][0])
+                else:
+                    params.setdefault(node_id, {})[param_item] = param_node['default']
+                continue
+
+            value = values[param_name]
+            if param_type == 'TEXT':
+                value = str(value)
+                if len(value) > param_node.get('max', len(value)):
+                    raise ParamError(f"{param_name} is longer than {param_node['max']}")
+            elif param_type == 'NUMBER':
+                number = int if isinstance(param_node['default'], int) else float
+                try:
+                    value = number(value)
+                except (TypeError, ValueError):
+                    raise ParamError(f"{param_name} must be a number")
+                if value < param_node.get('min', value) or value > param_node.get('max', value):
+                    raise ParamError(f"{param_name} must be in [{param_node.get('min')}, {param_node.get('max')}]")
+            elif param_type == 'SELECT':
+                if value not in param_node['options']:
+                    raise ParamError(f"{param_name} must be one of {param_node['options']}")
+            elif param_type == 'CHECKBOX':
+                if not isinstance(value, bool):
+                    raise ParamError(f"{param_name} must be true or false")
+            elif param_type in ('UPLOADIMAGE', 'UPLOADVIDEO'):
+                try:
+                    upload = ApiUpload(value['name'], base64.b64decode(value['data'], validate=True))
+                except Exception:
+                    raise ParamError(f"{param_name} must be {{\"name\": ..., \"data\": <base64>}}")
+                uploads.append((node_id, param_item, param_node.get('subfolder', ''), upload))
+                continue
+            params.setdefault(node_id, {})[param_item] = value
+
+    unknown = set(values) - known
+    if unknown:
+        raise ParamError(f"Unknown params {sorted(unknown)}")
+    return params, uploads
+
+
+class ApiEventQueue:
+    """
+    Progress queue of an api job, events are put by comfyui threads and read by the event loop.
+    Outputs of executed events are kept for GET /jobs/{job_id}.
+    """
+    def __init__(self, loop) -> None:
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        # node_id -> output of its executed event
+        self.outputs = {}
+
+    def put(self, event):
+        if event['type'] == 'executed':
+            self.outputs[event['data']['node']] = event['data']['output']
+        if event['type'] in API_EVENTS:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+
+class ApiRun:
+    def __init__(self, app_id, comfyflow, job, event_queue) -> None:
+        self.app_id = app_id
+        self.comfyflow = comfyflow
+        self.job = job
+        self.event_queue = event_queue
+
+    def finished(self):
+        return self.job.status in (JobStatus.FINISHED, JobStatus.ERROR, JobStatus.CANCELED)
+
+
+class ApiServer:
+    def __init__(self, workspace_model, comfy_backends, job_manager, tokens=None, keepalive=15) -> None:
+        self.workspace_model = workspace_model
+        self.comfy_backends = comfy_backends
+        self.job_manager = job_manager
+        self.upload_manager = create_upload_manager()
+        self.template_cache = TemplateCache()
+        # token -> user, no tokens lets every request in as user "api"
+        self.tokens = tokens or {}
+        self.keepalive = keepalive
+        # job_id -> ApiRun, kept as long as the job manager keeps the job
+        self.runs = {}
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.auth_middleware], client_max_size=200*1024*1024)
+        app.add_routes([
+            web.post("/apps/{app_id}/run", self.run_app),
+            web.get("/jobs/{job_id}", self.get_job),
+            web.get("/jobs/{job_id}/events", self.job_events),
+        ])
+        return app
+
+    @web.middleware
+    async def auth_middleware(self, request, handler):
+        username = 'api'
+        if self.tokens:
+            auth = request.headers.get('Authorization', '')
+            username = self.tokens.get(auth[len('Bearer '):]) if auth.startswith('Bearer ') else None
+            if username is None:
+                return web.json_response({"error": "unauthorized"}, status=401)
+        request['username'] = username
+        return await handler(request)
+
+    async def run_app(self, request):
+        loop = asyncio.get_running_loop()
+        app_id = request.match_info['app_id']
+        app = await loop.run_in_executor(None, self.workspace_model.get_app_by_id, app_id)
+        if app is None or app.status != AppStatus.INSTALLED.value:
+            return web.json_response({"error": f"App {app_id} is not installed"}, status=404)
+        try:
+            body = await request.json()
+            if not isinstance(body, dict):
+                raise ParamError("body must be a JSON object")
+            values = body.get('params', {})
+            if not isinstance(values, dict):
+                raise ParamError("params must be an object")
+            comfy_client = self.comfy_backends.select()
+            comfyflow = Comfyflow(comfy_client, app.api_conf, app.app_conf, app_id=app.id, app_version=app.updated_at,
+                                  template_cache=self.template_cache)
+            params, uploads = parse_params(comfyflow.app_json, values)
+        except (ParamError, ValueError) as e:
+            return web.json_response({"error": str(e)}, status=400)
+        except Exception as e:
+            logger.warning(f"api run app {app_id} error, {e}")
+            return web.json_response({"error": str(e)}, status=503)
+
+        try:
+            for node_id, param_item, subfolder, upload in uploads:
+                filename = await loop.run_in_executor(None, self.upload_manager.upload, comfy_client, upload, subfolder)
+                params.setdefault(node_id, {})[param_item] = filename
+            prompt = comfyflow.build_prompt(params)
+            event_queue = ApiEventQueue(loop)
+            job = self.job_manager.submit(request['username'], comfy_client, prompt, event_queue)
+        except JobQueueFullError as e:
+            return web.json_response({"error": str(e)}, status=429)
+        except Exception as e:
+            logger.warning(f"api run app {app_id} error, {e}")
+            return web.json_response({"error": str(e)}, status=502)
+
+        self.expire_runs()
+        self.runs[job.id] = ApiRun(app_id, comfyflow, job, event_queue)
+        logger.info(f"api run app {app_id}, job {job.id}")
+        return web.json_response({"job_id": job.id, "status": job.status.value,
+                                  "position": self.job_manager.position(job)}, status=202)
+
+    async def get_job(self, request):
+        run = self.runs.get(request.match_info['job_id'])
+        if run is None:
+            return web.json_response({"error": "Unknown job"}, status=404)
+        return web.json_response(await self.job_result(run))
+
+    async def job_events(self, request):
+        run = self.runs.get(request.match_info['job_id'])
+        if run is None:
+            return web.json_response({"error": "Unknown job"}, status=404)
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await resp.prepare(request)
+        event_queue = run.event_queue.queue
+        while True:
+            try:
+                event = await asyncio.wait_for(event_queue.get(), timeout=self.keepalive)
+            except asyncio.TimeoutError:
+                if run.finished() and event_queue.empty():
+                    break
+                await resp.write(b": keepalive\n\n")
+                continue
+            await resp.write(f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n".encode('utf-8'))
+            if (event['type'] == 'executing' and event['data'] is None) or event['type'] in ('execution_error', 'execution_interrupted'):
+                break
+
+        result = await self.job_result(run)
+        await resp.write(f"event: result\ndata: {json.dumps(result)}\n\n".encode('utf-8'))
+        return resp
+
+    async def job_result(self, run):
+        result = run.job.to_dict()
+        result['app_id'] = run.app_id
+        if run.job.status != JobStatus.FINISHED:
+            return result
+
+        comfy_client = self.comfy_backends.client_for(run.job.prompt_id, run.job.comfy_client)
+        outputs = dict(run.event_queue.outputs)
+        missing = [node_id for node_id in run.comfyflow.app_json['outputs'] if node_id not in outputs]
+        if missing:
+            # output nodes comfyui served from its cache send no executed event
+            loop = asyncio.get_running_loop()
+            history = await loop.run_in_executor(None, comfy_client.get_history, run.job.prompt_id)
+            history_outputs = history.get(run.job.prompt_id, {}).get('outputs', {})
+            outputs.update({node_id: history_outputs[node_id] for node_id in missing if node_id in history_outputs})
+
+        result['outputs'] = {}
+        for node_id in run.comfyflow.app_json['outputs']:
+            files = outputs.get(node_id, {}).get('images', []) + outputs.get(node_id, {}).get('gifs', [])
+            result['outputs'][node_id] = [dict(file, url=comfy_client.get_image_url(file['filename'], file['subfolder'], file['type']))
+                                          for file in files]
+        return result
+
+    def expire_runs(self):
+        for job_id in [job_id for job_id in self.runs if self.job_manager.get_job(job_id) is None]:
+            self.runs.pop(job_id)
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Comfyflow headless api')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='listen address')
+    parser.add_argument('--port', type=int, default=8180, help='listen port')
+    args = parser.parse_args()
+
+    tokens = parse_tokens(os.getenv('COMFYFLOW_API_TOKEN'))
+    if not tokens and not is_loopback(args.host):
+        # anyone who reaches the port could run apps
+        parser.error(f"listening on {args.host} requires COMFYFLOW_API_TOKEN")
+
+    comfy_backends = create_comfy_backends()
+    # api users send batches of requests, they get a larger share of the queue than page sessions
+    max_pending_per_user = int(os.getenv('COMFYFLOW_API_MAX_PENDING_JOBS_PER_USER', 20))
+    job_manager = create_job_manager(comfy_backends, max_pending_per_user=max_pending_per_user)
+    api_server = ApiServer(WorkspaceModel(), comfy_backends, job_manager,
+                           tokens=tokens)
+    logger.info(f"Comfyflow api listening on {args.host}:{args.port}")
+    web.run_app(api_server.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
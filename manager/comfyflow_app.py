@@ -55,18 +55,17 @@ args = parser.parse_args()
 page_header()
 
 with st.container():
-    apps = get_workspace_model().get_all_apps()
-    app_id_map = { str(app.id): app for app in apps} 
     app_id = args.app
     logger.info(f"load app app_id {app_id}")
+    app = get_workspace_model().get_app_by_id(app_id)
 
-    if app_id not in app_id_map:
+    if app is None:
         st.warning(f"App {app_id} hasn't existed")
     else:
-        app = app_id_map[app_id]
         app_data = app.app_conf
         api_data = app.api_conf
 
         from modules.comfyflow import Comfyflow
-        comfy_flow = Comfyflow(comfy_client=get_comfy_client(), api_data=api_data, app_data=app_data)
+        comfy_flow = Comfyflow(comfy_client=get_comfy_client(), api_data=api_data, app_data=app_data,
+                               app_id=app.id, app_version=app.updated_at)
         comfy_flow.create_ui(show_header=True)
\ No newline at end of file
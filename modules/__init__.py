@@ -1,6 +1,7 @@
 import os
 from loguru import logger
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from enum import Enum
 
 # enum app status
@@ -32,27 +33,141 @@ def get_myapp_model():
     myapp_model = MyAppModel()
     return myapp_model 
 
+def create_comfy_backends():
+    # also used outside streamlit, e.g. by the api server
+    from modules.comfyclient import ComfyClient, STATUS_TTL
+    from modules.backends import ComfyBackendPool
+    # one or more comfyui servers, separated by comma
+    server_addrs = [addr.strip() for addr in os.getenv('COMFYUI_SERVER_ADDR', '').split(',') if addr.strip()]
+    pool_maxsize = int(os.getenv('COMFYUI_POOL_MAXSIZE', 10))
+    max_retries = int(os.getenv('COMFYUI_MAX_RETRIES', 3))
+    connect_timeout = float(os.getenv('COMFYUI_CONNECT_TIMEOUT', 5))
+    read_timeout = float(os.getenv('COMFYUI_READ_TIMEOUT', 60))
+    max_concurrency = int(os.getenv('COMFYUI_FETCH_CONCURRENCY', 4))
+    preview_max_fps = float(os.getenv('COMFYUI_PREVIEW_MAX_FPS', 4))
+    health_interval = float(os.getenv('COMFYUI_HEALTH_INTERVAL', 5))
+    health_timeout = float(os.getenv('COMFYUI_HEALTH_TIMEOUT', 2))
+    status_ttl = float(os.getenv('COMFYUI_STATUS_TTL', STATUS_TTL))
+    comfy_clients = [ComfyClient(server_addr=server_addr, pool_maxsize=pool_maxsize, max_retries=max_retries,
+                                 timeout=(connect_timeout, read_timeout), max_concurrency=max_concurrency,
+                                 preview_max_fps=preview_max_fps, status_ttl=status_ttl)
+                     for server_addr in server_addrs]
+    comfy_backends = ComfyBackendPool(comfy_clients, health_interval=health_interval, status_ttl=status_ttl,
+                                      health_timeout=health_timeout)
+    return comfy_backends
+
 @st.cache_resource
+def get_comfy_backends():
+    logger.debug("get_comfy_backends")
+    return create_comfy_backends()
+
 def get_comfy_client():
-    logger.debug("get_comfy_client")
-    from modules.comfyclient import ComfyClient
-    server_addr = os.getenv('COMFYUI_SERVER_ADDR')
-    comfy_client = ComfyClient(server_addr=server_addr)
+    # the backend of this session while it takes work, else the least loaded healthy one
+    if get_script_run_ctx() is None:
+        return get_comfy_backends().select()
+    comfy_client = get_comfy_backends().select(prefer=st.session_state.get('comfy_backend'))
+    st.session_state['comfy_backend'] = comfy_client.server_addr
     return comfy_client
 
+def create_job_manager(comfy_backends, max_pending_per_user=None):
+    from modules.jobs import JobManager
+    max_inflight = int(os.getenv('COMFYFLOW_MAX_INFLIGHT_PROMPTS', 2 * len(comfy_backends.backends)))
+    max_pending = int(os.getenv('COMFYFLOW_MAX_PENDING_JOBS', 50))
+    if max_pending_per_user is None:
+        max_pending_per_user = int(os.getenv('COMFYFLOW_MAX_PENDING_JOBS_PER_USER', 3))
+    job_manager = JobManager(max_inflight=max_inflight, max_pending=max_pending,
+                             max_pending_per_user=max_pending_per_user, backend_pool=comfy_backends)
+    return job_manager
+
+@st.cache_resource
+def get_job_manager():
+    logger.debug("get_job_manager")
+    return create_job_manager(get_comfy_backends())
+
+@st.cache_resource
+def get_result_cache():
+    logger.debug("get_result_cache")
+    from modules.resultcache import ResultCache
+    # 0 disables the cache
+    max_mb = int(os.getenv('COMFYFLOW_RESULT_CACHE_MB', 1024))
+    if max_mb <= 0:
+        return None
+    cache_path = os.getenv('COMFYFLOW_RESULT_CACHE_DIR', '.cache/results')
+    result_cache = ResultCache(path=cache_path, max_bytes=max_mb*1024*1024)
+    return result_cache
+
+def create_upload_manager():
+    from modules.uploads import UploadManager
+    # seconds an uploaded file is assumed to stay on the backend
+    ttl = float(os.getenv('COMFYFLOW_UPLOAD_TTL', 3600))
+    upload_manager = UploadManager(ttl=ttl)
+    return upload_manager
+
+@st.cache_resource
+def get_upload_manager():
+    logger.debug("get_upload_manager")
+    return create_upload_manager()
+
+@st.cache_resource
+def get_view_proxy():
+    logger.debug("get_view_proxy")
+    from modules.viewproxy import ViewProxy
+    host = os.getenv('COMFYFLOW_PROXY_HOST', '0.0.0.0')
+    port = int(os.getenv('COMFYFLOW_PROXY_PORT', 8190))
+    # the address browsers reach the proxy at
+    public_url = os.getenv('COMFYFLOW_PROXY_PUBLIC_URL')
+    view_proxy = ViewProxy(get_comfy_backends(), host=host, port=port, public_url=public_url)
+    return view_proxy
+
+@st.cache_resource
+def get_rendition_maker():
+    logger.debug("get_rendition_maker")
+    from modules.renditions import RenditionMaker
+    # longest side of displayed output images, at most 1460, 0 displays the originals
+    max_size = int(os.getenv('COMFYFLOW_RENDITION_SIZE', 1460))
+    if max_size <= 0:
+        return None
+    # JPEG or PNG, the formats st.image displays without converting
+    format = os.getenv('COMFYFLOW_RENDITION_FORMAT', 'JPEG')
+    quality = int(os.getenv('COMFYFLOW_RENDITION_QUALITY', 85))
+    rendition_maker = RenditionMaker(max_size=max_size, format=format, quality=quality)
+    return rendition_maker
+
+@st.cache_resource
+def get_thumbnail_store():
+    logger.debug("get_thumbnail_store")
+    from modules.thumbnails import ThumbnailStore
+    thumbnail_store = ThumbnailStore()
+    return thumbnail_store
+
+def get_app_thumbnail_url(app):
+    # cacheable static url of the app icon, None if the app has none
+    if app.image_hash is None:
+        return None
+    return get_thumbnail_store().url(app.image_hash, load=get_workspace_model().get_thumbnail)
+
+@st.cache_resource
+def get_template_cache():
+    logger.debug("get_template_cache")
+    from modules.template import TemplateCache
+    template_cache = TemplateCache()
+    return template_cache
+
 def check_comfyui_alive():
     try:
-        get_comfy_client().queue_remaining()
-        return True
+        return get_comfy_backends().is_alive()
     except Exception as e:
         logger.warning(f"check comfyui alive error, {e}")
         return False    
 
-@st.cache_data(ttl=60)
+@st.cache_resource
 def get_comfyui_object_info():
     logger.debug("get_comfy_object_info")
-    comfy_client = get_comfy_client()
-    comfy_object_info = comfy_client.get_node_class()
+    from modules.objectinfo import ObjectInfoCache
+    cache_path = os.getenv('COMFYUI_OBJECT_INFO_CACHE', '.cache/object_info.db')
+    refresh_interval = float(os.getenv('COMFYUI_OBJECT_INFO_REFRESH', 60))
+    comfy_object_info = ObjectInfoCache(lambda: get_comfy_client().get_node_class(), path=cache_path,
+                                        refresh_interval=refresh_interval)
     return comfy_object_info
 
 
@@ -0,0 +1,172 @@
+import json
+import uuid
+import asyncio
+import threading
+import aiohttp
+from loguru import logger
+from modules.comfyclient import get_websocket_url, decode_websocket_message
+
+
+class AsyncComfyClient:
+    def __init__(self, server_addr, client_id=None, pool_maxsize=10, max_concurrency=4, timeout=(5, 60)) -> None:
+        self.client_id = client_id or str(uuid.uuid4())
+        self.server_addr = server_addr
+        self.pool_maxsize = pool_maxsize
+        self.max_concurrency = max_concurrency
+        # (connect timeout, read timeout) in seconds
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=timeout[0], sock_read=timeout[1])
+        self._session = None
+        logger.info(f"Async comfy client id: {self.client_id}, max_concurrency: {max_concurrency}")
+
+    async def get_session(self):
+        # the session is bound to the running event loop, create it lazily inside the loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.pool_maxsize, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def get_node_class(self):
+        object_info_url = f"{self.server_addr}/object_info"
+        logger.info(f"Got object info from {object_info_url}")
+        session = await self.get_session()
+        async with session.get(object_info_url) as resp:
+            if resp.status != 200:
+                raise Exception(f"Failed to get object info from {object_info_url}")
+            return await resp.json()
+
+    async def queue_remaining(self):
+        url = f"{self.server_addr}/prompt"
+        logger.info(f"Got remaining from {url}")
+        session = await self.get_session()
+        async with session.get(url) as resp:
+            if resp.status != 200:
+                raise Exception(f"Failed to get queue from {url}")
+            return (await resp.json())['exec_info']['queue_remaining']
+
+    async def queue_prompt(self, prompt):
+        p = {"prompt": prompt, "client_id": self.client_id}
+        data = json.dumps(p).encode('utf-8')
+        logger.info(f"Sending prompt to server, {self.client_id}")
+        session = await self.get_session()
+        async with session.post(f"{self.server_addr}/prompt", data=data) as resp:
+            if resp.status != 200:
+                raise Exception(f"Failed to send prompt to server, {resp.status}")
+            return await resp.json()
+
+    async def get_image(self, filename, subfolder, folder_type):
+        url = f"{self.server_addr}/view"
+        params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        logger.info(f"Getting image from server, {url} {params}")
+        session = await self.get_session()
+        async with session.get(url, params=params) as resp:
+            if resp.status != 200:
+                raise Exception(f"Failed to get image from server, {resp.status}")
+            return await resp.read()
+
+    async def get_images(self, images):
+        # fetch all images concurrently, at most max_concurrency downloads in flight
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def fetch(image):
+            async with semaphore:
+                return await self.get_image(image['filename'], image['subfolder'], image['type'])
+
+        return await asyncio.gather(*[fetch(image) for image in images])
+
+    async def upload_image(self, imagefile, subfolder, type, overwrite):
+        form = aiohttp.FormData()
+        form.add_field("subfolder", subfolder)
+        form.add_field("type", type)
+        form.add_field("overwrite", overwrite)
+        for field_name, (filename, fileobj) in imagefile.items():
+            form.add_field(field_name, fileobj, filename=filename)
+        logger.info(f"Uploading image to server, {subfolder} {type} {overwrite}")
+        session = await self.get_session()
+        async with session.post(f"{self.server_addr}/upload/image", data=form) as resp:
+            if resp.status != 200:
+                raise Exception(f"Failed to upload image to server, {resp.status}")
+            return await resp.json()
+
+    async def get_history(self, prompt_id):
+        logger.info(f"Getting history from server, {prompt_id}")
+        session = await self.get_session()
+        async with session.get(f"{self.server_addr}/history/{prompt_id}") as resp:
+            if resp.status != 200:
+                raise Exception(f"Failed to get history from server, {resp.status}")
+            return await resp.json()
+
+    async def get_outputs(self, prompt_id):
+        """
+        return: {node_id: [image bytes, ...]} for every output node with images
+        """
+        history = (await self.get_history(prompt_id))[prompt_id]
+        node_ids = [node_id for node_id in history['outputs'] if 'images' in history['outputs'][node_id]]
+        results = await asyncio.gather(*[self.get_images(history['outputs'][node_id]['images']) for node_id in node_ids])
+        return dict(zip(node_ids, results))
+
+    async def events(self):
+        """
+        async websocket, yield decoded events until the connection closes
+        """
+        ws_url = get_websocket_url(self.server_addr, self.client_id)
+        logger.info(f"Websocket connect url, {ws_url}")
+        session = await self.get_session()
+        async with session.ws_connect(ws_url, heartbeat=30) as ws:
+            async for msg in ws:
+                if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                    event = decode_websocket_message(msg.data)
+                    if event is not None:
+                        yield event
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    logger.error(f"Websocket error, {ws.exception()}")
+                    break
+
+
+class SyncComfyClient:
+    """
+    sync facade of AsyncComfyClient for streamlit pages, coroutines run on a private event loop thread
+    """
+    def __init__(self, async_client) -> None:
+        self.async_client = async_client
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="comfy-async-loop", daemon=True)
+        self.thread.start()
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def get_node_class(self):
+        return self._run(self.async_client.get_node_class())
+
+    def queue_remaining(self):
+        return self._run(self.async_client.queue_remaining())
+
+    def queue_prompt(self, prompt):
+        return self._run(self.async_client.queue_prompt(prompt))
+
+    def get_image(self, filename, subfolder, folder_type):
+        return self._run(self.async_client.get_image(filename, subfolder, folder_type))
+
+    def get_images(self, images):
+        return self._run(self.async_client.get_images(images))
+
+    def submit_images(self, images):
+        # concurrent.futures.Future of get_images, for fetching several outputs at once
+        return asyncio.run_coroutine_threadsafe(self.async_client.get_images(images), self.loop)
+
+    def upload_image(self, imagefile, subfolder, type, overwrite):
+        return self._run(self.async_client.upload_image(imagefile, subfolder, type, overwrite))
+
+    def get_history(self, prompt_id):
+        return self._run(self.async_client.get_history(prompt_id))
+
+    def get_outputs(self, prompt_id):
+        return self._run(self.async_client.get_outputs(prompt_id))
+
+    def close(self):
+        self._run(self.async_client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,145 @@
+import time
+import threading
+from collections import OrderedDict
+from loguru import logger
+from modules.comfyclient import STATUS_TTL
+
+
+class ComfyBackend:
+    def __init__(self, comfy_client) -> None:
+        self.comfy_client = comfy_client
+        self.server_addr = comfy_client.server_addr
+        self.healthy = False
+        # a draining backend finishes its running prompts but gets no new work
+        self.draining = False
+        # drained by the health check rather than by drain(), undrained once it recovers
+        self.health_drained = False
+        self.failures = 0
+        self.successes = 0
+        self.checked_at = None
+
+    @property
+    def queue_remaining(self):
+        # the latest of health check and websocket status
+        queue_status = self.comfy_client.queue_status
+        return queue_status[0] if queue_status is not None else 0
+
+    def load(self):
+        # comfyui queue plus prompts of this process it may not report yet
+        return self.queue_remaining + self.comfy_client.websocket.dispatcher.stats()['subscribers']
+
+    def to_dict(self):
+        return {
+            "server_addr": self.server_addr,
+            "healthy": self.healthy,
+            "draining": self.draining,
+            "queue_remaining": self.queue_remaining,
+            "failures": self.failures,
+            "checked_at": self.checked_at,
+        }
+
+
+class ComfyBackendPool:
+    """
+    A pool of comfyui servers. select() picks the healthy backend with the least queue, a health
+    check thread refreshes queue depth and marks a backend unhealthy after max_failures failed checks.
+    Liveness and queue depth are served from memory, so page reruns don't wait on comfyui.
+    The client that queued a prompt is recorded so history and view fetches go back to it.
+
+    An unhealthy backend is drained, and only gets new work again after max_failures checks in a row
+    succeed, so a flapping server doesn't take prompts between two failures.
+    """
+    def __init__(self, comfy_clients, health_interval=5, max_failures=2, max_bindings=10000, status_ttl=STATUS_TTL,
+                 health_timeout=2) -> None:
+        self.backends = [ComfyBackend(comfy_client) for comfy_client in comfy_clients]
+        self.health_interval = health_interval
+        # seconds a health probe may take, the first check runs while the page waits
+        self.health_timeout = health_timeout
+        self.status_ttl = status_ttl
+        self.max_failures = max_failures
+        self.max_bindings = max_bindings
+        # prompt_id -> comfy client
+        self.bindings = OrderedDict()
+        self.rotation = 0
+        self.lock = threading.Lock()
+        self.check_all()
+        self.thread = threading.Thread(target=self._health_loop, name="comfy-backend-health", daemon=True)
+        self.thread.start()
+        logger.info(f"Comfy backend pool, {[backend.server_addr for backend in self.backends]}")
+
+    def select(self, prefer=None):
+        """
+        prefer: server_addr of the backend a session used before, kept while it takes work,
+        so uploads, prompts and fetches of the session go to one backend
+        """
+        with self.lock:
+            candidates = [backend for backend in self.backends if backend.healthy and not backend.draining]
+            if len(candidates) == 0:
+                raise Exception("No healthy comfyui backend")
+            for backend in candidates:
+                if backend.server_addr == prefer:
+                    return backend.comfy_client
+            # rotate the candidates so equally loaded backends take turns
+            self.rotation = (self.rotation + 1) % len(candidates)
+            candidates = candidates[self.rotation:] + candidates[:self.rotation]
+            backend = min(candidates, key=lambda backend: backend.load())
+            logger.debug(f"Select backend {backend.server_addr}, load {backend.load()}")
+            return backend.comfy_client
+
+    def is_alive(self):
+        # served from memory, only checked in place when the health thread fell behind
+        now = time.time()
+        if all(backend.checked_at is None or now - backend.checked_at > self.status_ttl for backend in self.backends):
+            self.check_all()
+        return any(backend.healthy for backend in self.backends)
+
+    def bind(self, prompt_id, comfy_client):
+        with self.lock:
+            self.bindings[prompt_id] = comfy_client
+            while len(self.bindings) > self.max_bindings:
+                self.bindings.popitem(last=False)
+
+    def client_for(self, prompt_id, default=None):
+        # the client that queued the prompt, default when the binding is unknown or dropped
+        with self.lock:
+            return self.bindings.get(prompt_id, default)
+
+    def drain(self, server_addr, draining=True):
+        for backend in self.backends:
+            if backend.server_addr == server_addr:
+                backend.draining = draining
+                backend.health_drained = False
+                logger.info(f"Backend {server_addr} draining: {draining}")
+
+    def stats(self):
+        return [backend.to_dict() for backend in self.backends]
+
+    def check(self, backend):
+        try:
+            backend.comfy_client.probe_queue_remaining(timeout=self.health_timeout)
+            if not backend.healthy:
+                logger.info(f"Backend {backend.server_addr} is healthy")
+            backend.healthy = True
+            backend.failures = 0
+            backend.successes += 1
+            if backend.health_drained and backend.successes >= self.max_failures:
+                self.drain(backend.server_addr, False)
+        except Exception as e:
+            backend.failures += 1
+            backend.successes = 0
+            if backend.healthy and backend.failures >= self.max_failures:
+                logger.warning(f"Backend {backend.server_addr} is unhealthy, {e}")
+                backend.healthy = False
+                if not backend.draining:
+                    self.drain(backend.server_addr)
+                    backend.health_drained = True
+        backend.checked_at = time.time()
+
+    def check_all(self):
+        for backend in self.backends:
+            self.check(backend)
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            self.check_all()
@@ -0,0 +1,172 @@
+import time
+import queue
+import itertools
+from loguru import logger
+from modules.jobs import JobStatus, JobQueueFullError
+
+# job states a batch stops waiting for
+DONE_STATUSES = (JobStatus.FINISHED, JobStatus.ERROR, JobStatus.CANCELED)
+
+
+def parse_sweep_values(text, param_node, max_values=1000):
+    """
+    values of a swept param typed by the user
+    NUMBER: comma separated numbers or start:stop[:step] ranges, stop excluded
+    TEXT: one value per line
+    """
+    if param_node['type'] == 'TEXT':
+        return [line.strip() for line in text.splitlines() if line.strip()]
+
+    number = int if isinstance(param_node.get('default'), int) else float
+    values = []
+    for token in text.split(','):
+        token = token.strip()
+        if not token:
+            continue
+        if ':' in token:
+            bounds = [number(bound) for bound in token.split(':')]
+            start, stop, step = bounds[0], bounds[1], bounds[2] if len(bounds) > 2 else number(1)
+            if step <= 0:
+                raise Exception(f"Step of {token} must be positive")
+            value = start
+            while value < stop:
+                values.append(value)
+                value += step
+                if len(values) > max_values:
+                    raise Exception(f"More than {max_values} values")
+        else:
+            values.append(number(token))
+    return values
+
+
+def check_sweep_values(values, param_node):
+    """
+    reject values the param's input wouldn't accept, before any prompt of the batch is queued
+    NUMBER: within min and max, on the step from min
+    TEXT: at most max characters
+    SELECT: one of the options
+    """
+    param_name = param_node['name']
+    param_type = param_node['type']
+    for value in values:
+        if param_type == 'NUMBER':
+            param_min, param_max = param_node.get('min'), param_node.get('max')
+            if (param_min is not None and value < param_min) or (param_max is not None and value > param_max):
+                raise Exception(f"{param_name} value {value} is out of [{param_min}, {param_max}]")
+            step = param_node.get('step')
+            if step and param_min is not None:
+                steps = (value - param_min) / step
+                if abs(steps - round(steps)) > 1e-6:
+                    raise Exception(f"{param_name} value {value} is not on step {step} from {param_min}")
+        elif param_type == 'TEXT':
+            if 'max' in param_node and len(value) > param_node['max']:
+                raise Exception(f"{param_name} value is longer than {param_node['max']}")
+        elif param_type == 'SELECT':
+            if value not in param_node['options']:
+                raise Exception(f"{param_name} value {value} is not one of the options")
+
+
+def expand_sweep(params, sweeps):
+    """
+    params: {node_id: {param_item: value}} from the form, sweeps: {(node_id, param_item): [values]}
+    return: [(swept values, params)], one per combination of the swept values
+    """
+    keys = list(sweeps)
+    runs = []
+    for combination in itertools.product(*[sweeps[key] for key in keys]):
+        run_params = {node_id: dict(node_params) for node_id, node_params in params.items()}
+        for (node_id, param_item), value in zip(keys, combination):
+            run_params.setdefault(node_id, {})[param_item] = value
+        runs.append((dict(zip(keys, combination)), run_params))
+    return runs
+
+
+class BatchRun:
+    """
+    Submit the prompts of a batch through the job manager, at most concurrency of them at a time.
+    The next prompt is submitted as soon as one finishes, so comfyui always has work queued.
+
+    run() yields (index, job, executed) as each prompt finishes, executed holds the outputs of the
+    executed events of the prompt by node id. Other events are dropped while waiting.
+
+    timeout limits each prompt from its start, deadline the whole batch. At the deadline the running
+    prompts are stopped in comfyui and yielded as failed, prompts not submitted yet are left out and
+    expired is set.
+    """
+    def __init__(self, job_manager, username, comfy_client, prompts, concurrency=2, timeout=600, deadline=3600,
+                 poll_interval=0.2) -> None:
+        self.job_manager = job_manager
+        self.username = username
+        self.comfy_client = comfy_client
+        self.prompts = prompts
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.deadline = deadline
+        self.expired = False
+        self.poll_interval = poll_interval
+        self.completed = 0
+        self.failed = 0
+        self.started_at = None
+        # index -> job, of the submitted and unfinished prompts
+        self.running = {}
+        # index -> {node_id: output}
+        self.executed = {}
+
+    def prompts_per_minute(self):
+        if self.started_at is None or self.completed == 0:
+            return 0.0
+        return self.completed * 60 / max(time.monotonic() - self.started_at, 1e-6)
+
+    def cancel(self):
+        # the batch is abandoned, its prompts give their comfyui and job manager slots back
+        for job in self.running.values():
+            self.job_manager.cancel(job, stop=True)
+
+    def run(self):
+        self.started_at = time.monotonic()
+        next_index = 0
+        while next_index < len(self.prompts) or self.running:
+            while next_index < len(self.prompts) and len(self.running) < self.concurrency:
+                try:
+                    job = self.job_manager.submit(self.username, self.comfy_client, self.prompts[next_index], queue.Queue())
+                except JobQueueFullError as e:
+                    # try again when one of ours finished, or after the next poll
+                    logger.debug(f"batch submit deferred, {e}")
+                    break
+                self.running[next_index] = job
+                self.executed[next_index] = {}
+                next_index += 1
+
+            time.sleep(self.poll_interval)
+            if not self.expired and time.monotonic() - self.started_at > self.deadline:
+                logger.warning(f"batch deadline after {self.deadline}s, {len(self.running)} running, "
+                               f"{len(self.prompts) - next_index} not submitted")
+                self.expired = True
+                next_index = len(self.prompts)
+            for index, job in list(self.running.items()):
+                self._drain(index, job)
+                timed_out = self.expired or (job.started_at is not None and time.time() - job.started_at > self.timeout)
+                if job.status in DONE_STATUSES or timed_out:
+                    # events put right before the job finished
+                    self._drain(index, job)
+                    if timed_out and job.status not in DONE_STATUSES:
+                        logger.warning(f"batch job {job.id} timeout")
+                        self.job_manager.cancel(job, stop=True)
+                    self.running.pop(index)
+                    if job.status == JobStatus.FINISHED:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                    yield index, job, self.executed.pop(index)
+
+    def _drain(self, index, job):
+        progress_queue = job.progress_queue
+        if progress_queue is None:
+            return
+        while True:
+            try:
+                event = progress_queue.get_nowait()
+            except queue.Empty:
+                return
+            if event['type'] == 'executed':
+                self.executed[index][event['data']['node']] = event['data']['output']
@@ -1,24 +1,87 @@
 import json
+import time
 import uuid
 import requests
-import websocket
-from PIL import Image
-import io
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import threading
 from loguru import logger
 import urllib.parse as urlparse
+from modules.multipart import MultipartEncoder
+
+# seconds a queue depth from a health check or status event is served without asking comfyui
+STATUS_TTL = 15
 
 
 class ComfyClient:
-    def __init__(self, server_addr) -> None:
-        self.client_id = str(uuid.uuid4())
+    def __init__(self, server_addr, pool_maxsize=10, max_retries=3, backoff_factor=0.5, timeout=(5, 60),
+                 max_concurrency=4, preview_max_fps=4, status_ttl=STATUS_TTL) -> None:
         self.server_addr = server_addr
-        logger.info(f"Comfy client id: {self.client_id}")
+        # last known queue depth, (queue_remaining, updated_at), refreshed by queue_remaining() and websocket status events
+        self.status_ttl = status_ttl
+        self.queue_status = None
+        # the process wide websocket, routes events to sessions by prompt_id
+        from modules.comfyws import ComfyWebsocket
+        self.websocket = ComfyWebsocket(server_addr, str(uuid.uuid4()), preview_max_fps=preview_max_fps,
+                                        on_status=self.update_queue_status)
+        # (connect timeout, read timeout) in seconds
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.session = self._create_session(pool_maxsize, max_retries, backoff_factor)
+        # health probes get one attempt, a server that is down must fail fast
+        self.probe_session = requests.Session()
+        # max concurrent downloads of output images
+        self.max_concurrency = max_concurrency
+        self._async_client = None
+        self._async_lock = threading.Lock()
+        logger.info(f"Comfy client id: {self.client_id}, pool_maxsize: {pool_maxsize}, max_retries: {max_retries}, timeout: {timeout}")
+
+    @property
+    def client_id(self):
+        return self.websocket.client_id
+
+    def _create_session(self, pool_maxsize, max_retries, backoff_factor):
+        # only idempotent GETs are retried, a replayed POST /prompt would queue the prompt twice
+        retry = Retry(total=max_retries, connect=max_retries, read=max_retries, backoff_factor=backoff_factor,
+                      status_forcelist=[502, 503, 504], allowed_methods=["GET"], raise_on_status=False)
+        # keep-alive connections to comfyui, at most pool_maxsize connections per host
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=retry, pool_block=True)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def pool_stats(self):
+        """
+        return:
+        {
+            "requests": 10,     # requests sent through the pool
+            "connections": 1,   # new connections opened, a pool miss
+            "hits": 9,          # requests served by a kept-alive connection
+            "misses": 1
+        }
+        """
+        num_requests = 0
+        num_connections = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+        return {
+            "requests": num_requests,
+            "connections": num_connections,
+            "hits": max(num_requests - num_connections, 0),
+            "misses": num_connections,
+        }
 
     def get_node_class(self):
         object_info_url = f"{self.server_addr}/object_info"
         logger.info(f"Got object info from {object_info_url}")
-        resp = requests.get(object_info_url)
+        resp = self.session.get(object_info_url, timeout=self.timeout)
         if resp.status_code != 200:
             raise Exception(f"Failed to get object info from {object_info_url}")
         return resp.json()
@@ -30,18 +93,36 @@ class ComfyClient:
             "queue_remaining": 0
         }
         """
+        return self._get_queue_remaining(self.session, self.timeout)
+
+    def probe_queue_remaining(self, timeout=2):
+        # queue_remaining for health checks, without retries and with a short timeout
+        return self._get_queue_remaining(self.probe_session, timeout)
+
+    def _get_queue_remaining(self, session, timeout):
         url = f"{self.server_addr}/prompt"
-        logger.info(f"Got remaining from {url}")
-        resp = requests.get(url)
+        logger.debug(f"Got remaining from {url}")
+        resp = session.get(url, timeout=timeout)
         if resp.status_code != 200:
             raise Exception(f"Failed to get queue from {url}")
-        return resp.json()['exec_info']['queue_remaining']
+        queue_remaining = resp.json()['exec_info']['queue_remaining']
+        self.update_queue_status(queue_remaining)
+        return queue_remaining
+
+    def update_queue_status(self, queue_remaining):
+        self.queue_status = (queue_remaining, time.monotonic())
+
+    def cached_queue_remaining(self):
+        # served from memory while fresh, the backend health check and websocket keep it up to date
+        if self.queue_status is not None and time.monotonic() - self.queue_status[1] < self.status_ttl:
+            return self.queue_status[0]
+        return self.queue_remaining()
     
     def queue_prompt(self, prompt):
         p = {"prompt": prompt, "client_id": self.client_id}
         data = json.dumps(p).encode('utf-8')
         logger.info(f"Sending prompt to server, {self.client_id}")
-        resp = requests.post(f"{self.server_addr}/prompt", data=data)
+        resp = self.session.post(f"{self.server_addr}/prompt", data=data, timeout=self.timeout)
         if resp.status_code != 200:
             raise Exception(f"Failed to send prompt to server, {resp.status_code}")
         return resp.json()
@@ -49,123 +130,158 @@ class ComfyClient:
     def get_image(self, filename, subfolder, folder_type):
         url = f"{self.server_addr}/view?filename={filename}&subfolder={subfolder}&type={folder_type}"
         logger.info(f"Getting image from server, {url}")
-        resp = requests.get(url)
+        resp = self.session.get(url, timeout=self.timeout)
         if resp.status_code != 200:
             raise Exception(f"Failed to get image from server, {resp.status_code}")
         return resp.content
     
+    def get_images(self, images):
+        """
+        images: [{"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}, ...]
+        return: image bytes fetched concurrently, in the same order as images
+        """
+        return self.get_async_client().get_images(images)
+
+    def submit_images(self, images):
+        """
+        like get_images, but returns a concurrent.futures.Future of the image bytes
+        """
+        return self.get_async_client().submit_images(images)
+
+    def get_async_client(self):
+        # sync facade of AsyncComfyClient, created on first use
+        with self._async_lock:
+            if self._async_client is None:
+                from modules.async_comfyclient import AsyncComfyClient, SyncComfyClient
+                async_client = AsyncComfyClient(self.server_addr, client_id=self.client_id, pool_maxsize=self.pool_maxsize,
+                                                max_concurrency=self.max_concurrency, timeout=self.timeout)
+                self._async_client = SyncComfyClient(async_client)
+            return self._async_client
+
     def get_image_url(self, filename, subfolder, folder_type):
-        url = f"{self.server_addr}/view?filename={filename}&subfolder={subfolder}&type={folder_type}"
+        query = urlparse.urlencode({"filename": filename, "subfolder": subfolder, "type": folder_type})
+        url = f"{self.server_addr}/view?{query}"
         logger.info(f"Getting image url, {url}")
         return url
 
-    def upload_image(self, imagefile, subfolder, type, overwrite):
+    def upload_image(self, imagefile, subfolder, type, overwrite, progress=None):
         data = {"subfolder": subfolder, "type": type, "overwrite": overwrite}
         logger.info(f"Uploading image to server, {data}")
-        resp = requests.post(f"{self.server_addr}/upload/image", data=data, files=imagefile)
+        # streamed in chunks, a large video is never copied into one request body
+        body = MultipartEncoder(data, imagefile, progress=progress)
+        resp = self.session.post(f"{self.server_addr}/upload/image", data=body, timeout=self.timeout,
+                                 headers={"Content-Type": body.content_type})
         if resp.status_code != 200:
             raise Exception(f"Failed to upload image to server, {resp.status_code}")
         return resp.json()
 
     def get_history(self, prompt_id):
         logger.info(f"Getting history from server, {prompt_id}")
-        resp = requests.get(f"{self.server_addr}/history/{prompt_id}")
+        resp = self.session.get(f"{self.server_addr}/history/{prompt_id}", timeout=self.timeout)
         if resp.status_code != 200:
             raise Exception(f"Failed to get history from server, {resp.status_code}")
         return resp.json()
     
     
     def gen_images(self, prompt, queue):
+        prompt_id = self.send_prompt(prompt)
+        if queue is not None:
+            self.subscribe(prompt_id, queue)
+        return prompt_id
+
+    def send_prompt(self, prompt):
+        """
+        queue the prompt with the websocket connected, return its prompt_id. Events received before
+        subscribe() are held by the dispatcher and replayed, so the caller can record the prompt_id first.
+        """
         logger.info(f"Generating images from comfyui, {prompt}")
-        thread = threading.Thread(target=self._websocket_loop, args=(prompt, queue))
-        thread.start()
+        self.websocket.start()
+        if not self.websocket.connected.wait(timeout=self.timeout[0]):
+            logger.warning(f"Websocket is not connected yet, {self.server_addr}")
 
-        # queue prompt 
-        prompt_id = self.queue_prompt(prompt)['prompt_id']  
+        prompt_id = self.queue_prompt(prompt)['prompt_id']
         logger.info(f"Send prompt to comfyui, {prompt_id}")
-        
         return prompt_id
 
-    def _websocket_loop(self, prompt, queue):
-        urlresult = urlparse.urlparse(self.server_addr)
-        if urlresult.scheme == "http":
-            wc_connect = "ws://{}/ws?clientId={}".format(urlresult.netloc, self.client_id)
-        elif urlresult.scheme == "https":
-            wc_connect = "wss://{}/ws?clientId={}".format(urlresult.netloc, self.client_id)
-        logger.info(f"Websocket connect url, {wc_connect}")
-        ws = websocket.WebSocket()
-        ws.connect(wc_connect)
-
-        def dispatch_event(queue, event):            
-            if queue is not None:
-                event_type = event['type']
-                if event_type == 'b_preview':
-                    logger.debug(f"Dispatch event, {event_type}")
-                else:
-                    logger.debug(f"Dispatch event, {event}")
-                queue.put(event)
-            else:
-                logger.info("queue is none")
-
-        while True:
-            out = ws.recv()
-            try:
-                if isinstance(out, str):
-                    msg = json.loads(out)
-                    msg_type = msg['type']
-                    logger.debug(f"Got message from websocket server, {msg_type}, {msg}")
-                    if msg_type == "status":
-                        if "sid" in msg.get("data"):
-                            self.client_id = msg["data"]["sid"]
-                            # Set window.name to self.client_id
-                        status_data = msg["data"]["status"]
-                        # Dispatch status event with status_data
-                        dispatch_event(queue, {"type": "status", "data": status_data})
-                    elif msg_type == "progress":
-                        # Dispatch progress event with msg["data"]
-                        dispatch_event(queue, {"type": "progress", "data": msg["data"]})
-                    elif msg_type == "executing":
-                        # Dispatch executing event with msg["data"]["node"]
-                        dispatch_event(queue, {"type": "executing", "data": msg["data"]["node"]})
-                        if msg["data"]["node"] is None:
-                            logger.info("workflow finished, exiting websocket loop")
-                            break
-                    elif msg_type == "executed":
-                        # Dispatch executed event with msg["data"]
-                        dispatch_event(queue, {"type": "executed", "data": msg["data"]})
-                    elif msg_type == "execution_start":
-                        # Dispatch execution_start event with msg["data"]
-                        dispatch_event(queue, {"type": "execution_start", "data": msg["data"]})
-                    elif msg_type == "execution_error":
-                        # Dispatch execution_error event with msg["data"]
-                        dispatch_event(queue, {"type": "execution_error", "data": msg["data"]})
-                    elif msg_type == "execution_cached":
-                        # Dispatch execution_cached event with msg["data"]
-                        dispatch_event(queue, {"type": "execution_cached", "data": msg["data"]})
-                    else:
-                        logger.warning(f"Unknown message type {msg_type}")
-                    
-                elif isinstance(out, bytes):
-                    view = memoryview(out)
-                    event_type = int.from_bytes(view[:4], 'big')
-                    buffer = view[4:]
-                    if event_type == 1:
-                        view2 = memoryview(buffer)
-                        image_type = int.from_bytes(view2[:4], 'big')
-                        image_mime = ""
-                        if image_type == 1:
-                            image_mime = "image/jpeg"
-                        elif image_type == 2:
-                            image_mime = "image/png"
-                        
-                        image_blob = buffer[4:]
-                        logger.debug(f"Got binary websocket message of type {event_type}, {image_mime}, {len(image_blob)}")
-                        # Dispatch b_preview event with image_blob
-                        image = Image.open(io.BytesIO(image_blob))
-                        dispatch_event(queue, {"type": "b_preview", "data": image})
-                    else:
-                        logger.warning(f"Unknown binary websocket message of type {event_type}")      
-
-            except Exception as e:
-                logger.error(f"Error while processing websocket message, {e}")
-                raise e
+    def subscribe(self, prompt_id, queue):
+        # held events are replayed in this call, the final one included
+        self.websocket.subscribe(prompt_id, queue)
+
+    def delete_prompts(self, prompt_ids):
+        # remove prompts still waiting in the comfyui queue, a running prompt is not affected
+        logger.info(f"Deleting prompts from queue, {prompt_ids}")
+        resp = self.session.post(f"{self.server_addr}/queue", json={"delete": prompt_ids}, timeout=self.timeout)
+        if resp.status_code != 200:
+            raise Exception(f"Failed to delete prompts from queue, {resp.status_code}")
+
+    def interrupt(self, prompt_id):
+        # older comfyui versions interrupt whatever runs, only call it for a prompt known to be running
+        logger.info(f"Interrupting prompt, {prompt_id}")
+        resp = self.session.post(f"{self.server_addr}/interrupt", json={"prompt_id": prompt_id}, timeout=self.timeout)
+        if resp.status_code != 200:
+            raise Exception(f"Failed to interrupt prompt, {resp.status_code}")
+
+    def cancel_prompt(self, prompt_id):
+        """
+        stop a prompt queued by this client, interrupted if comfyui runs it, else deleted from the queue
+        return: True if it was interrupted, its execution_interrupted event follows
+        """
+        if self.websocket.dispatcher.running_prompt_id == prompt_id:
+            self.interrupt(prompt_id)
+            return True
+        self.delete_prompts([prompt_id])
+        return False
+
+    def unsubscribe(self, prompt_id):
+        # stop routing events of the prompt, e.g. the session started a new one
+        self.websocket.unsubscribe(prompt_id)
+
+
+def get_websocket_url(server_addr, client_id):
+    urlresult = urlparse.urlparse(server_addr)
+    if urlresult.scheme == "https":
+        return "wss://{}/ws?clientId={}".format(urlresult.netloc, client_id)
+    return "ws://{}/ws?clientId={}".format(urlresult.netloc, client_id)
+
+
+def decode_websocket_message(out):
+    """
+    decode a comfyui websocket message, text or binary, to an event
+    return: {"type": "progress", "data": {...}}, None for unknown message
+    """
+    if isinstance(out, str):
+        msg = json.loads(out)
+        msg_type = msg['type']
+        logger.debug(f"Got message from websocket server, {msg_type}, {msg}")
+        if msg_type == "status":
+            event = {"type": "status", "data": msg["data"]["status"]}
+            if "sid" in msg["data"]:
+                event["sid"] = msg["data"]["sid"]
+            return event
+        elif msg_type == "executing":
+            return {"type": "executing", "data": msg["data"]["node"], "prompt_id": msg["data"].get("prompt_id")}
+        elif msg_type in ("progress", "executed", "execution_start", "execution_error", "execution_cached", "execution_interrupted"):
+            return {"type": msg_type, "data": msg["data"], "prompt_id": msg["data"].get("prompt_id")}
+        else:
+            logger.warning(f"Unknown message type {msg_type}")
+
+    elif isinstance(out, bytes):
+        view = memoryview(out)
+        event_type = int.from_bytes(view[:4], 'big')
+        buffer = view[4:]
+        if event_type == 1:
+            view2 = memoryview(buffer)
+            image_type = int.from_bytes(view2[:4], 'big')
+            image_mime = ""
+            if image_type == 1:
+                image_mime = "image/jpeg"
+            elif image_type == 2:
+                image_mime = "image/png"
+            
+            image_blob = buffer[4:]
+            logger.debug(f"Got binary websocket message of type {event_type}, {image_mime}, {len(image_blob)}")
+            # keep the encoded frame, it is sent to the browser as is and most frames are throttled anyway
+            return {"type": "b_preview", "data": bytes(image_blob), "mime": image_mime}
+        else:
+            logger.warning(f"Unknown binary websocket message of type {event_type}")
+    return None
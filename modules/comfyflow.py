@@ -1,138 +1,340 @@
 from typing import Any
+import os
 import random
-import json
-import copy
 from PIL import Image
 from loguru import logger
 import queue
+from concurrent.futures import Future, as_completed
 
 import streamlit as st
 from streamlit_extras.row import row
 from modules.page import custom_text_area
+from modules.progress import ProgressWatcher, ProgressStatus
+from modules.jobs import JobStatus, JobQueueFullError
+from modules import get_comfy_backends, get_job_manager, get_result_cache, get_upload_manager, get_view_proxy, get_rendition_maker, get_template_cache
+from modules.renditions import guess_image_type
+from modules.resultcache import get_prompt_key
+from modules.template import PromptTemplate
+from modules.batch import BatchRun, parse_sweep_values, check_sweep_values, expand_sweep
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# values of COMFYFLOW_OUTPUT_DELIVERY
+OUTPUT_DELIVERIES = ('bytes', 'url', 'proxy')
 
 class Comfyflow:
-    def __init__(self, comfy_client, api_data, app_data) -> Any:
+    def __init__(self, comfy_client, api_data, app_data, app_id=None, app_version=None, template_cache=None) -> Any:
     
         self.comfy_client = comfy_client
-        self.api_json = json.loads(api_data)
-        self.app_json = json.loads(app_data)
+        # prompt compiled once per app version, apps without an id are compiled for this instance
+        if app_id is None:
+            self.template = PromptTemplate(api_data, app_data)
+        else:
+            template_cache = template_cache or get_template_cache()
+            self.template = template_cache.get(app_id, app_version, api_data, app_data)
+        # shared with the cached template, read only
+        self.api_json = self.template.api_json
+        self.app_json = self.template.app_json
+        # prompts with randomized seeds never repeat, their results aren't looked up or stored
+        self.cacheable = len(self.template.seed_slots) == 0
+        # seconds to wait for the next event, and for the whole prompt
+        self.event_timeout = float(os.getenv('COMFYUI_EVENT_TIMEOUT', 120))
+        self.total_timeout = float(os.getenv('COMFYUI_GENERATE_TIMEOUT', 600))
+        # bytes: images pass through this process, url: browsers load comfyui /view directly,
+        # proxy: browsers load /view through the local streaming proxy
+        self.output_delivery = os.getenv('COMFYFLOW_OUTPUT_DELIVERY', 'bytes').strip().lower()
+        if self.output_delivery not in OUTPUT_DELIVERIES:
+            logger.error(f"Unknown COMFYFLOW_OUTPUT_DELIVERY {self.output_delivery}, one of {OUTPUT_DELIVERIES}, use bytes")
+            self.output_delivery = 'bytes'
+        # most prompts of one batch, and how many of them are queued in comfyui at once
+        self.batch_max = int(os.getenv('COMFYFLOW_BATCH_MAX', 100))
+        self.batch_concurrency = int(os.getenv('COMFYFLOW_BATCH_CONCURRENCY', 2))
+        # seconds the whole batch may take, it blocks the page like a single generate does,
+        # prompts still waiting then are not run
+        self.batch_timeout = float(os.getenv('COMFYFLOW_BATCH_TIMEOUT', self.total_timeout))
 
-    def generate(self):
-        prompt = copy.deepcopy(self.api_json)
-        if prompt is not None:
-            # update seed and noise_seed for random, if not set
-            for node_id in prompt:
-                node = prompt[node_id]
-                node_inputs = node['inputs']
-                for param_name in node_inputs:
-                    param_value = node_inputs[param_name]
-                    if isinstance(param_value, int):
-                        if (param_name == "seed" or param_name == "noise_seed"):
-                            random_value = random.randint(0, 0x7fffffffffffffff)
-                            prompt[node_id]['inputs'][param_name] = random_value
-                            logger.info(f"update prompt with random, {node_id} {param_name} {param_value} to {random_value}")
-
-            # update prompt inputs with app_json config
-            for node_id in self.app_json['inputs']:
-                node = self.app_json['inputs'][node_id]
-                node_inputs = node['inputs']
-                for param_item in node_inputs:
-                    logger.info(f"update param {param_item}, {node_inputs[param_item]}")
-                    param_type = node_inputs[param_item]['type']
-                    if param_type == "TEXT":
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
+    def collect_params(self):
+        """
+        values of the app inputs in the session, {node_id: {param_item: value}}, and the content hashes
+        of the uploaded files, the prompt only holds their names. None when an input file is missing.
+        """
+        params = {}
+        input_hashes = []
+        for node_id in self.app_json['inputs']:
+            node = self.app_json['inputs'][node_id]
+            node_inputs = node['inputs']
+            for param_item in node_inputs:
+                param_type = node_inputs[param_item]['type']
+                param_name = node_inputs[param_item]['name']
+                param_key = f"{node_id}_{param_name}"
+                if param_type in ("TEXT", "NUMBER", "SELECT", "CHECKBOX"):
+                    param_value = st.session_state[param_key]
+                    logger.info(f"update param {param_key} {param_name} {param_value}")
+                    params.setdefault(node_id, {})[param_item] = param_value
+
+                elif param_type in ('UPLOADIMAGE', 'UPLOADVIDEO'):
+                    if param_key in st.session_state:
                         param_value = st.session_state[param_key]
+                        
                         logger.info(f"update param {param_key} {param_name} {param_value}")
-                        prompt[node_id]["inputs"][param_item] = param_value
+                        if param_value is not None:
+                            # content-addressed name, uploaded only if this backend doesn't have it yet
+                            param_subfolder = node_inputs[param_item].get('subfolder', '')
+                            upload_manager = get_upload_manager()
+                            params.setdefault(node_id, {})[param_item] = upload_manager.upload(self.comfy_client, param_value, param_subfolder)
+                            input_hashes.append(upload_manager.digest(param_value))
+                        else:
+                            input_kind = 'image' if param_type == 'UPLOADIMAGE' else 'video'
+                            st.error(f"Please select input {input_kind} for param {param_name}")
+                            return None, None
+        return params, input_hashes
 
-                    elif param_type == "NUMBER":
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
-                        param_value = st.session_state[param_key]
-                        logger.info(f"update param {param_key} {param_name} {param_value}")                        
-                        prompt[node_id]["inputs"][param_item] = param_value
+    def build_prompt(self, params):
+        # random seeds and the params written over a shallow copy of the compiled prompt
+        return self.template.render(params)
 
-                    elif param_type == "SELECT":
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
-                        param_value = st.session_state[param_key]
-                        logger.info(f"update param {param_key} {param_name} {param_value}")
-                        prompt[node_id]["inputs"][param_item] = param_value
+    def generate(self):
+        params, input_hashes = self.collect_params()
+        if params is not None:
+            prompt = self.build_prompt(params)
 
-                    elif param_type == "CHECKBOX":
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
-                        param_value = st.session_state[param_key]
-                        logger.info(f"update param {param_key} {param_name} {param_value}")
-                        prompt[node_id]["inputs"][param_item] = param_value
+            job_manager = get_job_manager()
+            last_job = st.session_state.get('preview_job')
+            if last_job is not None:
+                job_manager.cancel(last_job)
+                st.session_state['preview_job'] = None
+
+            # the same prompt and inputs ran before, serve its outputs without comfyui
+            result_cache = get_result_cache() if self.cacheable else None
+            cache_key = get_prompt_key(prompt, input_hashes) if result_cache is not None else None
+            st.session_state['preview_cache_key'] = cache_key
+            st.session_state['preview_cached'] = result_cache.get(cache_key) if result_cache is not None else None
+            if st.session_state['preview_cached'] is not None:
+                logger.info(f"generate served from result cache, {cache_key}")
+                return
 
-                    elif param_type == 'UPLOADIMAGE':
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
-                        if param_key in st.session_state:
-                            param_value = st.session_state[param_key]
-                            
-                            logger.info(f"update param {param_key} {param_name} {param_value}")
-                            if param_value is not None:
-                                prompt[node_id]["inputs"][param_item] = param_value.name
-                            else:
-                                st.error(f"Please select input image for param {param_name}")
-                                return
-                    elif param_type == 'UPLOADVIDEO':
-                        param_name = node_inputs[param_item]['name']
-                        param_key = f"{node_id}_{param_name}"
-                        if param_key in st.session_state:
-                            param_value = st.session_state[param_key]
-                            
-                            logger.info(f"update param {param_key} {param_name} {param_value}")
-                            if param_value is not None:
-                                prompt[node_id]["inputs"][param_item] = param_value.name
-                            else:
-                                st.error(f"Please select input video for param {param_name}")
-                                return
-                            
             logger.info(f"Sending prompt to server, {prompt}")
-            queue = st.session_state.get('progress_queue', None)
+            # a fresh queue per prompt, events of a previous prompt never reach this one
+            progress_queue = queue.Queue()
+            st.session_state['progress_queue'] = progress_queue
+            st.session_state['preview_job_error'] = None
             try:
-                prompt_id = self.comfy_client.gen_images(prompt, queue)
-                st.session_state['preview_prompt_id'] = prompt_id
-                logger.info(f"generate prompt id: {prompt_id}")
+                username = st.session_state.get('username') or get_script_run_ctx().session_id
+                job = job_manager.submit(username, self.comfy_client, prompt, progress_queue)
+                st.session_state['preview_job'] = job
+                logger.info(f"generate job id: {job.id}")
+            except JobQueueFullError as e:
+                st.session_state['preview_job'] = None
+                st.session_state['preview_job_error'] = str(e)
+                logger.warning(f"generate job rejected, {e}")
             except Exception as e:
-                st.session_state['preview_prompt_id'] = None
+                st.session_state['preview_job'] = None
                 logger.warning(f"generate prompt error, {e}")
 
-    def get_outputs(self):
-        # get output images by prompt_id
-        prompt_id = st.session_state['preview_prompt_id']
-        if prompt_id is None:
-            return None
-        history = self.comfy_client.get_history(prompt_id)[prompt_id]
-        for node_id in self.app_json['outputs']:
-            node_output = history['outputs'][node_id]
-            logger.info(f"Got output from server, {node_id}, {node_output}")
-            if 'images' in node_output:
-                images_output = []
-                for image in node_output['images']:
-                    # image_url = self.comfy_client.get_image_url(image['filename'], image['subfolder'], image['type'])
-                    # images_output.append(image_url)
-                    image_data = self.comfy_client.get_image(image['filename'], image['subfolder'], image['type'])
-                    images_output.append(image_data)
-                    
-                logger.info(f"Got images from server, {node_id}, {len(images_output)}")
+    def fetch_output(self, comfy_client, node_id, node_output):
+        """
+        (type, outputs) of an output node, outputs is a future of the image bytes when they pass through this process
+        """
+        logger.info(f"Got output from server, {node_id}, {node_output}")
+        if 'images' in node_output:
+            if self.output_delivery in ('url', 'proxy'):
+                images_output = [self.get_output_url(comfy_client, image) for image in node_output['images']]
                 return 'images', images_output
-            elif 'gifs' in node_output:
-                gifs_output = []
-                format = 'gifs'
-                for gif in node_output['gifs']:
-                    if gif['format'] == 'image/gif' or gif['format'] == 'image/webp':
-                        format = 'images'
-                    gif_url = self.comfy_client.get_image_url(gif['filename'], gif['subfolder'], gif['type'])
-                    gifs_output.append(gif_url)
-
-                logger.info(f"Got gifs from server, {node_id}, {len(gifs_output)}")
-                return format, gifs_output
-        
+            return 'images', comfy_client.submit_images(node_output['images'])
+        elif 'gifs' in node_output:
+            gifs_output = []
+            format = 'gifs'
+            for gif in node_output['gifs']:
+                if gif['format'] == 'image/gif' or gif['format'] == 'image/webp':
+                    format = 'images'
+                gif_url = self.get_output_url(comfy_client, gif)
+                gifs_output.append(gif_url)
+            return format, gifs_output
+        return None, None
+
+    def get_history_outputs(self, comfy_client, prompt_id, node_ids):
+        # outputs of nodes without an executed event, comfyui doesn't run cached nodes again
+        logger.info(f"Get outputs from history, {prompt_id}, {node_ids}")
+        history = comfy_client.get_history(prompt_id)[prompt_id]
+        outputs = {}
+        for node_id in node_ids:
+            node_output = history['outputs'].get(node_id)
+            if node_output is None:
+                logger.warning(f"No output from server, {node_id}")
+                continue
+            outputs[node_id] = self.fetch_output(comfy_client, node_id, node_output)
+        return outputs
+
+    def cache_outputs(self, outputs, cache_key):
+        # outputs: node_id -> (type, outputs), stored when every output node has image bytes
+        result_cache = get_result_cache()
+        if result_cache is None or cache_key is None or len(outputs) != len(self.app_json['outputs']):
+            return
+        if all(output_type == 'images' and all(isinstance(image, bytes) for image in images)
+               for output_type, images in outputs.values()):
+            result_cache.put(cache_key, {node_id: outputs[node_id] for node_id in self.app_json['outputs']})
+
+    def cache_stats_text(self):
+        # hit rate and bytes served from the result cache since the process started
+        result_cache = get_result_cache()
+        if result_cache is None or not self.cacheable:
+            return ""
+        stats = result_cache.stats()
+        return f", result cache hit rate {stats['hit_rate']:.0%}, {stats['bytes_saved'] / 1024 / 1024:.1f} MB saved"
+
+    def get_prompt_client(self, job):
+        # history and outputs of a prompt are on the backend that queued it
+        return get_comfy_backends().client_for(job.prompt_id, job.comfy_client)
+
+    def get_output_url(self, comfy_client, output):
+        if self.output_delivery == 'proxy':
+            return get_view_proxy().get_image_url(comfy_client, output['filename'], output['subfolder'], output['type'])
+        return comfy_client.get_image_url(output['filename'], output['subfolder'], output['type'])
+
+    def show_output(self, placeholder, node_id, output_type, outputs):
+        if output_type == 'images':
+            self.show_images(placeholder, node_id, outputs)
+        elif output_type == 'gifs':
+            with placeholder.container():
+                for output in outputs:
+                    st.markdown(f'<iframe src="{output}" width="100%" height="360px"></iframe>', unsafe_allow_html=True)
+
+    def show_images(self, placeholder, node_id, images):
+        # urls are loaded by the browser, bytes are displayed as a smaller rendition
+        rendition_maker = get_rendition_maker()
+        if rendition_maker is None or len(images) == 0 or not isinstance(images[0], bytes):
+            placeholder.image(images, use_column_width=True)
+            return
+
+        with placeholder.container():
+            st.image(rendition_maker.render_all(images), use_column_width=True, output_format=rendition_maker.format)
+            for i, image in enumerate(images):
+                ext, mime = guess_image_type(image)
+                st.download_button(f"Download original {i+1}", image, file_name=f"output_{node_id}_{i+1}.{ext}",
+                                   mime=mime, key=f"download_{node_id}_{i}")
+
+    def get_sweep_params(self):
+        # {node_id}_{param_item} -> (node_id, param_item, param config), of the inputs a batch can sweep
+        sweep_params = {}
+        for node_id in self.app_json['inputs']:
+            node_inputs = self.app_json['inputs'][node_id]['inputs']
+            for param_item in node_inputs:
+                if node_inputs[param_item]['type'] in ("NUMBER", "SELECT", "TEXT"):
+                    sweep_params[f"{node_id}_{param_item}"] = (node_id, param_item, node_inputs[param_item])
+        return sweep_params
+
+    def create_ui_batch(self):
+        sweep_params = self.get_sweep_params()
+        if len(sweep_params) == 0:
+            return False
+        with st.expander("Batch"):
+            selected = st.multiselect("Sweep params", options=list(sweep_params), key="batch_sweep_params",
+                                      format_func=lambda key: sweep_params[key][2]['name'],
+                                      help="Run the app for every combination of the values of these params")
+            for key in selected:
+                param_node = sweep_params[key][2]
+                param_name = param_node['name']
+                batch_key = f"batch_{key}"
+                if param_node['type'] == "SELECT":
+                    st.multiselect(f"{param_name} values", options=param_node['options'], key=batch_key)
+                elif param_node['type'] == "NUMBER":
+                    st.text_input(f"{param_name} values", placeholder="1, 2, 3 or 0:50", key=batch_key,
+                                  help="Comma separated numbers, or start:stop[:step] with stop excluded")
+                else:
+                    st.text_area(f"{param_name} values", key=batch_key, help="One value per line")
+            return st.button("Run batch", use_container_width=True, disabled=len(selected) == 0)
+
+    def run_batch(self, progress_placeholder, gallery_placeholder):
+        sweep_params = self.get_sweep_params()
+        sweeps = {}
+        try:
+            for key in st.session_state.get('batch_sweep_params', []):
+                node_id, param_item, param_node = sweep_params[key]
+                values = st.session_state.get(f"batch_{key}")
+                if param_node['type'] != "SELECT":
+                    values = parse_sweep_values(values or '', param_node, max_values=self.batch_max)
+                if not values:
+                    st.error(f"Please input values of {param_node['name']}")
+                    return
+                check_sweep_values(values, param_node)
+                sweeps[(node_id, param_item)] = values
+        except Exception as e:
+            st.error(f"Invalid batch values, {e}")
+            return
+
+        params, input_hashes = self.collect_params()
+        if params is None:
+            return
+        runs = expand_sweep(params, sweeps)
+        if len(runs) > self.batch_max:
+            st.error(f"Batch has {len(runs)} prompts, at most {self.batch_max} are allowed")
+            return
+
+        prompts = [self.build_prompt(run_params) for _, run_params in runs]
+        cache_keys = [get_prompt_key(prompt, input_hashes) if self.cacheable else None for prompt in prompts]
+        output_progress = progress_placeholder.progress(0.0, text=f"Batch of {len(runs)} prompts")
+        gallery = gallery_placeholder.container()
+        columns = gallery.columns(4)
+        cells = [columns[index % 4].empty() for index in range(len(runs))]
+        rendition_maker = get_rendition_maker()
+
+        def show_run(index, outputs):
+            caption = ", ".join(f"{sweep_params[f'{node_id}_{param_item}'][2]['name']}: {value}"
+                                for (node_id, param_item), value in runs[index][0].items())
+            for output_type, images in outputs.values():
+                if output_type == 'images' and len(images) > 0:
+                    image = images[0]
+                    if rendition_maker is not None and isinstance(image, bytes):
+                        cells[index].image(rendition_maker.render(image), use_column_width=True, caption=caption,
+                                           output_format=rendition_maker.format)
+                        return
+                    cells[index].image(image, use_column_width=True, caption=caption)
+                    return
+            cells[index].caption(f"{caption}, no image output")
+
+        # runs served from the result cache, the rest goes to comfyui
+        result_cache = get_result_cache()
+        pending = []
+        done = 0
+        for index, cache_key in enumerate(cache_keys):
+            cached = result_cache.get(cache_key) if result_cache is not None and cache_key is not None else None
+            if cached is not None:
+                show_run(index, cached)
+                done += 1
+            else:
+                pending.append(index)
+
+        username = st.session_state.get('username') or get_script_run_ctx().session_id
+        batch = BatchRun(get_job_manager(), username, self.comfy_client, [prompts[index] for index in pending],
+                         concurrency=self.batch_concurrency, timeout=self.total_timeout, deadline=self.batch_timeout)
+        not_run = set(pending)
+        try:
+            for batch_index, job, executed in batch.run():
+                index = pending[batch_index]
+                not_run.discard(index)
+                done += 1
+                if job.status != JobStatus.FINISHED:
+                    cells[index].error(f"Prompt {index + 1} failed, {job.error or 'timeout'}")
+                else:
+                    node_outputs = {node_id: self.fetch_output(self.get_prompt_client(job), node_id, executed[node_id])
+                                    for node_id in self.app_json['outputs'] if node_id in executed}
+                    missing = [node_id for node_id in self.app_json['outputs'] if node_id not in node_outputs]
+                    if len(missing) > 0:
+                        node_outputs.update(self.get_history_outputs(self.get_prompt_client(job), job.prompt_id, missing))
+                    outputs = {node_id: (output_type, result.result() if isinstance(result, Future) else result)
+                               for node_id, (output_type, result) in node_outputs.items()}
+                    self.cache_outputs(outputs, cache_keys[index])
+                    show_run(index, outputs)
+                output_progress.progress(done / len(runs), text=f"{done}/{len(runs)} prompts, {batch.prompts_per_minute():.1f} prompts/min")
+        finally:
+            # the page was left or rerun, don't leave prompts of this batch waiting
+            batch.cancel()
+        if batch.expired:
+            for index in not_run:
+                cells[index].warning(f"Prompt {index + 1} not run, the batch took over {self.batch_timeout:.0f}s")
+        logger.info(f"Batch finished, {len(runs)} prompts, {len(runs) - len(pending)} cached, {batch.failed} failed, "
+                    f"{batch.prompts_per_minute():.1f} prompts/min")
+        output_progress.progress(1.0, text=f"Batch finished, {len(runs)} prompts, {len(runs) - len(pending)} cached, "
+                                           f"{batch.prompts_per_minute():.1f} prompts/min{self.cache_stats_text()}")
 
     def create_ui_input(self, node_id, node_inputs):
         def random_seed(param_key):
@@ -195,10 +397,8 @@ class Comfyflow:
                 uploaded_file = st.file_uploader(param_name, help=param_help, key=param_key, type=['png', 'jpg', 'jpeg'], accept_multiple_files=False)
                 if uploaded_file is not None:
                     logger.info(f"uploading image, {uploaded_file}")
-                    # upload to server
-                    upload_type = "input"
-                    imagefile = {'image': (uploaded_file.name, uploaded_file)}  # 替换为要上传的文件名和路径
-                    self.comfy_client.upload_image(imagefile, param_subfolder, upload_type, 'true')
+                    # upload to server, skipped when this content is already there
+                    get_upload_manager().upload(self.comfy_client, uploaded_file, param_subfolder)
 
                     # show image preview
                     image = Image.open(uploaded_file)
@@ -211,10 +411,12 @@ class Comfyflow:
                 uploaded_file = st.file_uploader(param_name, help=param_help, key=param_key, type=['mp4', "h264"], accept_multiple_files=False)
                 if uploaded_file is not None:
                     logger.info(f"uploading image, {uploaded_file}")
-                    # upload to server
-                    upload_type = "input"
-                    imagefile = {'image': (uploaded_file.name, uploaded_file)}  # 替换为要上传的文件名和路径
-                    self.comfy_client.upload_image(imagefile, param_subfolder, upload_type, 'true')
+                    # upload to server, skipped when this content is already there
+                    upload_placeholder = st.empty()
+                    def upload_progress(sent, total):
+                        upload_placeholder.progress(sent / total, text=f"Uploading video, {sent // (1024*1024)}/{total // (1024*1024)} MB")
+                    get_upload_manager().upload(self.comfy_client, uploaded_file, param_subfolder, progress=upload_progress)
+                    upload_placeholder.empty()
 
                     # show video preview
                     st.video(uploaded_file, format="video/mp4", start_time=0)
@@ -243,6 +445,7 @@ class Comfyflow:
                     self.create_ui_input(node_id, node_inputs)
 
                 gen_button = st.button(label='Generate', use_container_width=True, on_click=self.generate)
+                batch_button = self.create_ui_batch()
 
 
         with output_col:
@@ -250,55 +453,124 @@ class Comfyflow:
             with st.container():
                 node_size = len(self.api_json)
                 executed_nodes = []
-                queue_remaining = self.comfy_client.queue_remaining()
+                queue_remaining = self.comfy_client.cached_queue_remaining()
                 output_queue_remaining = st.text(f"Queue: {queue_remaining}")
                 progress_placeholder = st.empty()
                 img_placeholder = st.empty()
-                if gen_button:
-                    if st.session_state['preview_prompt_id'] is None:
-                        st.warning("Generate failed, please check ComfyFlowApp and ComfyUI console log.")
+                # one placeholder per output node, filled as each node's outputs arrive
+                output_placeholders = {node_id: st.empty() for node_id in self.app_json['outputs']}
+                refresh_button = False
+                if st.session_state.get('preview_waiting') and not gen_button:
+                    refresh_button = st.button("Refresh result", help="Keep waiting for the running prompt")
+                cached = st.session_state.get('preview_cached') if gen_button else None
+                if batch_button:
+                    self.run_batch(progress_placeholder, img_placeholder)
+                elif cached is not None:
+                    for node_id, (output_type, outputs) in cached.items():
+                        if node_id in output_placeholders:
+                            self.show_output(output_placeholders[node_id], node_id, output_type, outputs)
+                    progress_placeholder.progress(1.0, text=f"Generate finished, cached result{self.cache_stats_text()}")
+                    st.session_state[f'{app_name}_previewed'] = True
+                elif gen_button or refresh_button:
+                    job = st.session_state.get('preview_job')
+                    if job is None:
+                        job_error = st.session_state.get('preview_job_error')
+                        if job_error:
+                            st.warning(f"Server is busy, please try again later. {job_error}")
+                        else:
+                            st.warning("Generate failed, please check ComfyFlowApp and ComfyUI console log.")
                         st.stop()
 
+                    # node_id -> (type, outputs or future of outputs), from executed events as each output node finishes
+                    node_outputs = {}
+                    shown_outputs = {}
+                    def show_outputs(wait=False):
+                        fetches = {}
+                        for node_id, (output_type, outputs) in node_outputs.items():
+                            if node_id in shown_outputs:
+                                continue
+                            if isinstance(outputs, Future):
+                                fetches[outputs] = node_id
+                            else:
+                                shown_outputs[node_id] = (output_type, outputs)
+                                self.show_output(output_placeholders[node_id], node_id, output_type, outputs)
+                        done = as_completed(fetches) if wait else [future for future in fetches if future.done()]
+                        for future in done:
+                            node_id = fetches[future]
+                            output_type, outputs = node_outputs[node_id][0], future.result()
+                            logger.info(f"Got images from server, {node_id}, {len(outputs)}")
+                            shown_outputs[node_id] = (output_type, outputs)
+                            self.show_output(output_placeholders[node_id], node_id, output_type, outputs)
+
                     # update progress
                     output_progress = progress_placeholder.progress(value=0.0, text="Generate image")
-                    while True:
-                        try:
-                            progress_queue = st.session_state.get('progress_queue')
-                            event = progress_queue.get()
+                    progress_queue = st.session_state.get('progress_queue')
+                    watcher = ProgressWatcher(progress_queue, event_timeout=self.event_timeout, total_timeout=self.total_timeout,
+                                              is_alive=lambda: job.status == JobStatus.PENDING or job.comfy_client.websocket.is_alive())
+                    try:
+                        for event in watcher.events():
                             logger.debug(f"event: {event}")
 
                             event_type = event['type']
                             if event_type == 'status':
                                 remaining = event['data']['exec_info']['queue_remaining']
                                 output_queue_remaining.text(f"Queue: {remaining}")
+                            elif event_type == 'job':
+                                position = event['data']['position']
+                                if position > 0:
+                                    output_queue_remaining.text(f"Waiting for a free slot, position: {position}")
+                                else:
+                                    # the job got its slot
+                                    output_queue_remaining.text(f"Queue: {self.comfy_client.cached_queue_remaining()}")
                             elif event_type == 'execution_cached':
                                 executed_nodes.extend(event['data']['nodes'])
-                                output_progress.progress(len(executed_nodes)/node_size, text="Generate image...")
+                                output_progress.progress(min(len(executed_nodes)/node_size, 1.0), text="Generate image...")
                             elif event_type == 'executing':
                                 node = event['data']
                                 if node is None:
-                                    type, outputs = self.get_outputs()
-                                    if type == 'images' and outputs is not None:
-                                        img_placeholder.image(outputs, use_column_width=True)
-                                    elif type == 'gifs' and outputs is not None:
-                                        for output in outputs:
-                                            img_placeholder.markdown(f'<iframe src="{output}" width="100%" height="360px"></iframe>', unsafe_allow_html=True)
-
-                                    output_progress.progress(1.0, text="Generate finished")
+                                    img_placeholder.empty()
+                                    missing = [node_id for node_id in self.app_json['outputs'] if node_id not in node_outputs]
+                                    if len(missing) > 0:
+                                        node_outputs.update(self.get_history_outputs(self.get_prompt_client(job), job.prompt_id, missing))
+                                    show_outputs(wait=True)
+                                    self.cache_outputs(shown_outputs, st.session_state.get('preview_cache_key'))
+
+                                    output_progress.progress(1.0, text=f"Generate finished{self.cache_stats_text()}")
                                     logger.info("Generating finished")
                                     st.session_state[f'{app_name}_previewed'] = True
-                                    break
                                 else:
                                     executed_nodes.append(node)
-                                    output_progress.progress(len(executed_nodes)/node_size, text="Generating image...")
+                                    output_progress.progress(min(len(executed_nodes)/node_size, 1.0), text="Generating image...")
+                            elif event_type == 'executed':
+                                node_id = event['data']['node']
+                                if node_id in output_placeholders and node_id not in node_outputs:
+                                    output_type, outputs = self.fetch_output(self.get_prompt_client(job), node_id, event['data']['output'])
+                                    if output_type is not None:
+                                        node_outputs[node_id] = (output_type, outputs)
                             elif event_type == 'b_preview':
-                                preview_image = event['data']
-                                img_placeholder.image(preview_image, use_column_width=True, caption="Preview")
-                        except Exception as e:
-                            logger.warning(f"get progress exception, {e}")
-                            # st.warning(f"get progress exception {e}")
+                                # pass the encoded frame through, matching output_format avoids re-encoding
+                                preview_format = 'PNG' if event.get('mime') == 'image/png' else 'JPEG'
+                                img_placeholder.image(event['data'], use_column_width=True, caption="Preview", output_format=preview_format)
+                            elif event_type == 'execution_error':
+                                logger.warning(f"execution error, {event['data']}")
+                                st.error(f"Generate failed, {event['data'].get('exception_message', 'execution error')}")
+
+                            # outputs whose fetch completed meanwhile
+                            show_outputs()
+                    except Exception as e:
+                        logger.warning(f"get progress exception, {e}")
+                        st.error(f"Generate failed, {e}")
+                        watcher.status = ProgressStatus.ERROR
+
+                    # keep the partial progress and free the script thread, the prompt keeps running in comfyui
+                    st.session_state['preview_waiting'] = watcher.status in (ProgressStatus.STALLED, ProgressStatus.TIMEOUT)
+                    if watcher.status == ProgressStatus.STALLED:
+                        st.warning(f"No progress from ComfyUI for {self.event_timeout}s, click Refresh result to keep waiting.")
+                    elif watcher.status == ProgressStatus.TIMEOUT:
+                        st.warning(f"Generate took longer than {self.total_timeout}s, click Refresh result to keep waiting.")
+                    elif watcher.status == ProgressStatus.PRODUCER_DEAD:
+                        st.error("Lost the connection to ComfyUI, please check ComfyFlowApp and ComfyUI console log.")
                 else:
                     output_image = Image.open('./public/images/output-none.png')
                     logger.info("default output")
                     img_placeholder.image(output_image, use_column_width=True, caption='None Image, Generate it!')
-                                
\ No newline at end of file
@@ -0,0 +1,233 @@
+import time
+import threading
+from collections import OrderedDict
+import websocket
+from loguru import logger
+from modules.comfyclient import get_websocket_url, decode_websocket_message
+
+# events that end a prompt, the subscription is removed after dispatching them
+FINISHED_EVENTS = ('execution_error', 'execution_interrupted')
+
+
+def is_finished_event(event):
+    # the final executing event, or an error, ends the prompt
+    return (event['type'] == 'executing' and event['data'] is None) or event['type'] in FINISHED_EVENTS
+
+
+class EventDispatcher:
+    """
+    Route comfyui events to the queue subscribed for their prompt_id.
+
+    A prompt_id is only known after POST /prompt returns, but comfyui may already have sent the first
+    events of the prompt, so events of an unknown prompt are held for pending_ttl seconds and replayed
+    on subscribe. Events nobody subscribed to within that window are dropped.
+
+    Preview frames are forwarded at most preview_max_fps per prompt, the frames in between are skipped.
+    """
+    def __init__(self, pending_ttl=10, max_pending=1000, preview_max_fps=4) -> None:
+        self.pending_ttl = pending_ttl
+        self.max_pending = max_pending
+        self.preview_interval = 1.0 / preview_max_fps if preview_max_fps > 0 else 0
+        # prompt_id -> time of the last forwarded preview
+        self.preview_sent_at = {}
+        # prompt_id -> queue
+        self.subscribers = {}
+        # prompt_id -> [(received_at, event), ...]
+        self.pending = OrderedDict()
+        self.pending_size = 0
+        # binary preview frames carry no prompt_id, they belong to the prompt being executed
+        self.running_prompt_id = None
+        self.lock = threading.Lock()
+        self.delivered = 0
+        self.dropped = 0
+        self.previews_skipped = 0
+
+    def subscribe(self, prompt_id, queue):
+        with self.lock:
+            self.subscribers[prompt_id] = queue
+            events = self.pending.pop(prompt_id, [])
+            self.pending_size -= len(events)
+            logger.debug(f"Subscribe prompt {prompt_id}, subscribers {len(self.subscribers)}, replay {len(events)} events")
+            for _, event in events:
+                self._deliver(prompt_id, queue, event)
+            # a prompt served from comfyui's cache may be over before anyone subscribed
+            if any(is_finished_event(event) for _, event in events):
+                logger.info(f"Prompt {prompt_id} finished before subscribe")
+                self.subscribers.pop(prompt_id, None)
+                self.preview_sent_at.pop(prompt_id, None)
+
+    def unsubscribe(self, prompt_id):
+        with self.lock:
+            self.subscribers.pop(prompt_id, None)
+            self.preview_sent_at.pop(prompt_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "subscribers": len(self.subscribers),
+                "pending": self.pending_size,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "previews_skipped": self.previews_skipped,
+            }
+
+    def dispatch(self, event):
+        with self.lock:
+            self._expire_pending()
+            event_type = event['type']
+            if event_type == 'status':
+                # queue status is interesting for every session
+                for prompt_id, queue in self.subscribers.items():
+                    self._deliver(prompt_id, queue, event)
+                return
+
+            prompt_id = event.pop('prompt_id', None) or self.running_prompt_id
+            if event_type == 'execution_start':
+                self.running_prompt_id = prompt_id
+            finished = is_finished_event(event)
+            if finished and self.running_prompt_id == prompt_id:
+                self.running_prompt_id = None
+
+            if prompt_id is None:
+                self.dropped += 1
+                return
+
+            queue = self.subscribers.get(prompt_id)
+            if queue is not None:
+                if event_type == 'b_preview' and self._skip_preview(prompt_id):
+                    return
+                self._deliver(prompt_id, queue, event)
+                if finished:
+                    logger.info(f"Prompt {prompt_id} finished, {event_type}")
+                    self.subscribers.pop(prompt_id, None)
+                    self.preview_sent_at.pop(prompt_id, None)
+            elif event_type == 'b_preview':
+                # a stale preview is useless, don't hold it
+                self.dropped += 1
+            else:
+                self.pending.setdefault(prompt_id, []).append((time.monotonic(), event))
+                self.pending_size += 1
+
+    def _skip_preview(self, prompt_id):
+        now = time.monotonic()
+        if now - self.preview_sent_at.get(prompt_id, 0) < self.preview_interval:
+            self.previews_skipped += 1
+            return True
+        self.preview_sent_at[prompt_id] = now
+        return False
+
+    def _deliver(self, prompt_id, queue, event):
+        event_type = event['type']
+        if event_type == 'b_preview':
+            logger.debug(f"Dispatch event, {event_type}, {prompt_id}")
+        else:
+            logger.debug(f"Dispatch event, {event}, {prompt_id}")
+        queue.put(event)
+        self.delivered += 1
+
+    def _expire_pending(self):
+        deadline = time.monotonic() - self.pending_ttl
+        while self.pending:
+            prompt_id, events = next(iter(self.pending.items()))
+            if events[-1][0] > deadline and self.pending_size <= self.max_pending:
+                break
+            self.pending.pop(prompt_id)
+            self.pending_size -= len(events)
+            self.dropped += len(events)
+            logger.debug(f"Drop {len(events)} events of prompt {prompt_id}, nobody subscribed")
+
+
+class ComfyWebsocket:
+    """
+    One long-lived websocket to comfyui per client, shared by all sessions of the process.
+
+    The thread reconnects forever, so is_alive() reports the connection: it's alive while connected,
+    or disconnected for less than disconnect_grace seconds.
+    """
+    def __init__(self, server_addr, client_id, recv_timeout=30, max_reconnect_delay=30, preview_max_fps=4,
+                 on_status=None, disconnect_grace=10) -> None:
+        self.server_addr = server_addr
+        # called with queue_remaining of every status event
+        self.on_status = on_status
+        self.client_id = client_id
+        self.recv_timeout = recv_timeout
+        self.max_reconnect_delay = max_reconnect_delay
+        self.dispatcher = EventDispatcher(preview_max_fps=preview_max_fps)
+        self.connected = threading.Event()
+        self.disconnect_grace = disconnect_grace
+        self.disconnected_at = time.monotonic()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.disconnected_at = time.monotonic()
+                self.thread = threading.Thread(target=self._run, name="comfy-websocket", daemon=True)
+                self.thread.start()
+                logger.info(f"Start websocket thread, {self.server_addr}")
+
+    def is_alive(self):
+        if self.thread is None or not self.thread.is_alive():
+            return False
+        if self.connected.is_set():
+            return True
+        return time.monotonic() - self.disconnected_at < self.disconnect_grace
+
+    def subscribe(self, prompt_id, queue):
+        self.dispatcher.subscribe(prompt_id, queue)
+
+    def unsubscribe(self, prompt_id):
+        self.dispatcher.unsubscribe(prompt_id)
+
+    def _connect(self):
+        ws_url = get_websocket_url(self.server_addr, self.client_id)
+        logger.info(f"Websocket connect url, {ws_url}")
+        ws = websocket.WebSocket()
+        ws.connect(ws_url, timeout=self.recv_timeout)
+        return ws
+
+    def _run(self):
+        reconnect_delay = 1
+        while True:
+            ws = None
+            try:
+                ws = self._connect()
+                self.connected.set()
+                reconnect_delay = 1
+                while True:
+                    try:
+                        out = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        # idle, check the connection is still alive
+                        ws.ping()
+                        continue
+                    self._dispatch(out)
+            except Exception as e:
+                logger.warning(f"Websocket disconnected, {e}, reconnect in {reconnect_delay}s")
+            finally:
+                if self.connected.is_set():
+                    self.disconnected_at = time.monotonic()
+                self.connected.clear()
+                if ws is not None:
+                    ws.close()
+            time.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, self.max_reconnect_delay)
+
+    def _dispatch(self, out):
+        try:
+            event = decode_websocket_message(out)
+        except Exception as e:
+            logger.error(f"Error while processing websocket message, {e}")
+            return
+        if event is None:
+            return
+
+        if event['type'] == 'status':
+            sid = event.pop('sid', None)
+            if sid is not None and sid != self.client_id:
+                logger.info(f"Websocket sid changed, {self.client_id} to {sid}")
+                self.client_id = sid
+            if self.on_status is not None:
+                self.on_status(event['data']['exec_info']['queue_remaining'])
+        self.dispatcher.dispatch(event)
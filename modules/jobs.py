@@ -0,0 +1,242 @@
+import time
+import uuid
+import threading
+from enum import Enum
+from collections import OrderedDict, deque
+from loguru import logger
+
+
+class JobStatus(Enum):
+    PENDING = "Pending"
+    RUNNING = "Running"
+    FINISHED = "Finished"
+    ERROR = "Error"
+    CANCELED = "Canceled"
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, username, comfy_client, prompt, progress_queue) -> None:
+        self.id = str(uuid.uuid4())
+        self.username = username
+        self.comfy_client = comfy_client
+        self.prompt = prompt
+        self.progress_queue = progress_queue
+        self.status = JobStatus.PENDING
+        self.prompt_id = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "username": self.username,
+            "status": self.status.value,
+            "prompt_id": self.prompt_id,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobEventQueue:
+    """
+    Stands in for the session progress queue while a job runs, forwards every event to it
+    and tells the manager when the prompt is done.
+    """
+    def __init__(self, manager, job) -> None:
+        self.manager = manager
+        self.job = job
+
+    def put(self, event):
+        # finish before forwarding, a reader of the final event sees the job done
+        event_type = event['type']
+        if event_type == 'executing' and event['data'] is None:
+            self.manager.finish(self.job, JobStatus.FINISHED)
+        elif event_type in ('execution_error', 'execution_interrupted'):
+            self.manager.finish(self.job, JobStatus.ERROR, error=event_type)
+        if self.job.progress_queue is not None:
+            self.job.progress_queue.put(event)
+
+
+class JobManager:
+    """
+    In-process queue in front of ComfyClient.send_prompt.
+
+    At most max_inflight prompts are queued in comfyui at a time, the rest wait here. Pending jobs
+    are taken round-robin by user, so one user's burst can't starve the others. submit() rejects
+    with JobQueueFullError when the queue, or the user's share of it, is full.
+    """
+    def __init__(self, max_inflight=2, max_pending=50, max_pending_per_user=3, workers=2,
+                 job_timeout=1800, job_ttl=3600, backend_pool=None) -> None:
+        self.max_inflight = max_inflight
+        # records which backend queued each prompt
+        self.backend_pool = backend_pool
+        self.max_pending = max_pending
+        self.max_pending_per_user = max_pending_per_user
+        # a running job without a final event after job_timeout seconds gives its slot back
+        self.job_timeout = job_timeout
+        # finished jobs can be polled for job_ttl seconds
+        self.job_ttl = job_ttl
+        # username -> deque of pending jobs, users are served in order and rotated
+        self.user_queues = OrderedDict()
+        self.pending = 0
+        self.running = {}
+        self.jobs = {}
+        self.cond = threading.Condition()
+        self.workers = [threading.Thread(target=self._worker_loop, name=f"comfy-job-worker-{i}", daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        logger.info(f"Job manager started, max_inflight: {max_inflight}, max_pending: {max_pending}, workers: {workers}")
+
+    def submit(self, username, comfy_client, prompt, progress_queue=None):
+        with self.cond:
+            user_queue = self.user_queues.get(username)
+            if self.pending >= self.max_pending:
+                raise JobQueueFullError(f"Job queue is full, {self.pending} jobs waiting")
+            if user_queue is not None and len(user_queue) >= self.max_pending_per_user:
+                raise JobQueueFullError(f"User {username} has {len(user_queue)} jobs waiting")
+
+            job = Job(username, comfy_client, prompt, progress_queue)
+            if user_queue is None:
+                user_queue = self.user_queues[username] = deque()
+            user_queue.append(job)
+            self.pending += 1
+            self.jobs[job.id] = job
+            logger.info(f"Submit job {job.id} for {username}, pending {self.pending}, running {len(self.running)}")
+            self._notify_positions()
+            self.cond.notify()
+            return job
+
+    def get_job(self, job_id):
+        with self.cond:
+            return self.jobs.get(job_id)
+
+    def position(self, job):
+        # 1-based position in the dispatch order, 0 when not pending
+        with self.cond:
+            return self._positions().get(job.id, 0)
+
+    def cancel(self, job, stop=False):
+        """
+        stop=True also stops a running job's prompt in comfyui, so it gives its slot back,
+        otherwise the prompt runs to the end and only its events are no longer forwarded
+        """
+        stop_prompt = False
+        with self.cond:
+            if job.status == JobStatus.PENDING:
+                user_queue = self.user_queues.get(job.username)
+                if user_queue is not None and job in user_queue:
+                    user_queue.remove(job)
+                    self.pending -= 1
+                    if len(user_queue) == 0:
+                        self.user_queues.pop(job.username)
+                job.status = JobStatus.CANCELED
+                job.finished_at = time.time()
+                self._notify_positions()
+            elif job.status == JobStatus.RUNNING:
+                job.progress_queue = None
+                stop_prompt = stop and job.prompt_id is not None
+
+        if stop_prompt:
+            try:
+                interrupted = job.comfy_client.cancel_prompt(job.prompt_id)
+            except Exception as e:
+                logger.warning(f"Job {job.id} cancel prompt {job.prompt_id} error, {e}")
+                return
+            if not interrupted:
+                # deleted from the comfyui queue, no final event will come
+                self.finish(job, JobStatus.CANCELED)
+
+    def finish(self, job, status, error=None):
+        with self.cond:
+            if self.running.pop(job.id, None) is None:
+                return
+            job.status = status
+            job.error = error
+            job.finished_at = time.time()
+            logger.info(f"Job {job.id} {status.value}, prompt {job.prompt_id}, took {job.finished_at - job.started_at:.1f}s")
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "pending": self.pending,
+                "running": len(self.running),
+                "users": len(self.user_queues),
+                "jobs": len(self.jobs),
+            }
+
+    def _positions(self):
+        # round-robin dispatch order of pending jobs
+        positions = {}
+        queues = [list(user_queue) for user_queue in self.user_queues.values()]
+        index = 0
+        while any(queues):
+            for user_queue in queues:
+                if user_queue:
+                    index += 1
+                    positions[user_queue.pop(0).id] = index
+        return positions
+
+    def _notify_positions(self):
+        for job_id, position in self._positions().items():
+            job = self.jobs[job_id]
+            if job.progress_queue is not None:
+                job.progress_queue.put({"type": "job", "data": {"status": job.status.value, "position": position}})
+
+    def _next_job(self):
+        username, user_queue = next(iter(self.user_queues.items()))
+        job = user_queue.popleft()
+        self.pending -= 1
+        # rotate the user to the end, or drop it when it has nothing left
+        self.user_queues.pop(username)
+        if len(user_queue) > 0:
+            self.user_queues[username] = user_queue
+        return job
+
+    def _expire(self):
+        now = time.time()
+        for job in list(self.running.values()):
+            if now - job.started_at > self.job_timeout:
+                logger.warning(f"Job {job.id} timeout, prompt {job.prompt_id}, release its slot")
+                self.running.pop(job.id)
+                job.status = JobStatus.ERROR
+                job.error = "timeout"
+                job.finished_at = now
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished_at and now - job.finished_at > self.job_ttl]:
+            self.jobs.pop(job_id)
+
+    def _worker_loop(self):
+        while True:
+            with self.cond:
+                while self.pending == 0 or len(self.running) >= self.max_inflight:
+                    self.cond.wait(timeout=10)
+                    self._expire()
+                job = self._next_job()
+                job.status = JobStatus.RUNNING
+                job.started_at = time.time()
+                self.running[job.id] = job
+                self._notify_positions()
+
+            if job.progress_queue is not None:
+                job.progress_queue.put({"type": "job", "data": {"status": job.status.value, "position": 0}})
+            try:
+                job.prompt_id = job.comfy_client.send_prompt(job.prompt)
+                if self.backend_pool is not None:
+                    self.backend_pool.bind(job.prompt_id, job.comfy_client)
+                logger.info(f"Job {job.id} queued in comfyui, prompt {job.prompt_id}")
+                # subscribe after the prompt_id is recorded, held events may finish the job right here
+                job.comfy_client.subscribe(job.prompt_id, JobEventQueue(self, job))
+            except Exception as e:
+                logger.warning(f"Job {job.id} failed to queue prompt, {e}")
+                self.finish(job, JobStatus.ERROR, error=str(e))
+                if job.progress_queue is not None:
+                    job.progress_queue.put({"type": "execution_error", "data": {"exception_message": str(e)}})
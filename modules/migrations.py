@@ -0,0 +1,107 @@
+from loguru import logger
+from sqlalchemy import text
+from modules.thumbnails import THUMBNAIL_TABLE, init_thumbnail_table, put_thumbnail
+
+"""
+schema_version table, one row per applied migration
+    version INTEGER
+    description TEXT
+    applied_at TEXT
+"""
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+
+
+def get_columns(s, table):
+    return [column.name for column in s.execute(text(f'PRAGMA table_info({table});')).fetchall()]
+
+
+def add_column(s, table, column, column_type):
+    # databases made before the migrations may have the column already
+    if column not in get_columns(s, table):
+        s.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {column_type};'))
+
+
+def create_comfyflow_apps(s):
+    s.execute(text('CREATE TABLE IF NOT EXISTS comfyflow_apps (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, description TEXT, image TEXT, app_conf TEXT, api_conf TEXT, template TEXT, url TEXT, status TEXT, created_at TEXT, updated_at TEXT);'))
+    s.execute(text('CREATE INDEX IF NOT EXISTS comfyflow_apps_name_index ON comfyflow_apps (name);'))
+    add_column(s, 'comfyflow_apps', 'username', 'TEXT')
+    add_column(s, 'comfyflow_apps', 'workflow_conf', 'TEXT')
+
+
+def create_my_apps(s):
+    s.execute(text('CREATE TABLE IF NOT EXISTS my_apps (id TEXT PRIMARY KEY, name TEXT, description TEXT, image TEXT, app_conf TEXT, api_conf TEXT, template TEXT, url TEXT, status TEXT, created_at TEXT, updated_at TEXT);'))
+    s.execute(text('CREATE INDEX IF NOT EXISTS my_apps_name_index ON my_apps (name);'))
+
+
+def move_icons_to_thumbnails(s):
+    init_thumbnail_table(s)
+    add_column(s, 'comfyflow_apps', 'image_hash', 'TEXT')
+    add_column(s, 'my_apps', 'image_hash', 'TEXT')
+    # icons stored inline in app rows
+    for table in ('comfyflow_apps', 'my_apps'):
+        sql = text(f'SELECT id, image FROM {table} WHERE image IS NOT NULL AND image_hash IS NULL;')
+        for app in s.execute(sql).fetchall():
+            image_hash = put_thumbnail(s, app.image)
+            sql = text(f'UPDATE {table} SET image=NULL, image_hash=:image_hash WHERE id=:id;')
+            s.execute(sql, dict(id=app.id, image_hash=image_hash))
+            logger.info(f"move icon of {table} app {app.id} to {THUMBNAIL_TABLE}, {image_hash}")
+
+
+def add_my_apps_sync_columns(s):
+    add_column(s, 'my_apps', 'sync_hash', 'TEXT')
+    add_column(s, 'my_apps', 'username', 'TEXT')
+
+
+def add_app_indexes(s):
+    # status filters of the listings, the id order is served by the rowid in the index
+    s.execute(text('CREATE INDEX IF NOT EXISTS comfyflow_apps_status_index ON comfyflow_apps (status);'))
+    s.execute(text('CREATE INDEX IF NOT EXISTS comfyflow_apps_username_index ON comfyflow_apps (username);'))
+    s.execute(text('CREATE INDEX IF NOT EXISTS comfyflow_apps_updated_at_index ON comfyflow_apps (updated_at);'))
+    s.execute(text('CREATE INDEX IF NOT EXISTS my_apps_status_index ON my_apps (status);'))
+    s.execute(text('CREATE INDEX IF NOT EXISTS my_apps_updated_at_index ON my_apps (updated_at);'))
+
+
+# (version, description, migration), append new migrations at the end and never change applied ones.
+# They run in one BEGIN IMMEDIATE transaction, DDL included, but should stay safe to run again.
+MIGRATIONS = [
+    (1, "create comfyflow_apps", create_comfyflow_apps),
+    (2, "create my_apps", create_my_apps),
+    (3, "move app icons to app_thumbnails", move_icons_to_thumbnails),
+    (4, "add sync_hash and username to my_apps", add_my_apps_sync_columns),
+    (5, "index app status, username and updated_at", add_app_indexes),
+]
+
+
+def get_schema_version(s):
+    sql = text('SELECT name FROM sqlite_master WHERE type=:type AND name=:name;')
+    if s.execute(sql, dict(type='table', name=SCHEMA_VERSION_TABLE)).fetchone() is None:
+        return 0
+    version = s.execute(text(f'SELECT MAX(version) FROM {SCHEMA_VERSION_TABLE};')).scalar()
+    return version or 0
+
+
+def migrate(writer, migrations=MIGRATIONS):
+    """
+    apply the migrations newer than the schema version of the database, in one transaction of the writer.
+    return the schema version.
+    """
+    def apply(s):
+        # take the write lock before reading the version, another process starting on the same
+        # database waits here and then finds the migrations applied
+        s.execute(text('BEGIN IMMEDIATE;'))
+        version = get_schema_version(s)
+        pending = [migration for migration in migrations if migration[0] > version]
+        if not pending:
+            return version, []
+        s.execute(text(f'CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (version INTEGER PRIMARY KEY, description TEXT, applied_at TEXT);'))
+        for migration_version, description, migration in pending:
+            logger.info(f"apply migration {migration_version}, {description}")
+            migration(s)
+            sql = text(f'INSERT INTO {SCHEMA_VERSION_TABLE} (version, description, applied_at) VALUES (:version, :description, datetime("now"));')
+            s.execute(sql, dict(version=migration_version, description=description))
+        return pending[-1][0], pending
+
+    version, applied = writer.transaction(apply)
+    logger.info(f"schema version {version}, {len(applied)} migrations applied")
+    return version
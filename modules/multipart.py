@@ -0,0 +1,84 @@
+import os
+import uuid
+from loguru import logger
+
+
+class MultipartEncoder:
+    """
+    A multipart/form-data body read in chunks, for requests to stream instead of building it in memory.
+
+    fields is a dict of form values, files a dict of name -> (filename, file object or bytes). File objects
+    are read from their current position, only chunk_size bytes are buffered at a time. progress is called
+    with (bytes_sent, total_bytes) whenever another percent of the body has been read.
+    """
+    def __init__(self, fields, files, chunk_size=64*1024, progress=None) -> None:
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.chunk_size = chunk_size
+        self.progress = progress
+        # bytes or (file object, size) in body order
+        self.parts = []
+        for name, value in fields.items():
+            self.parts.append(self._header(name) + b"\r\n" + str(value).encode('utf-8') + b"\r\n")
+        for name, (filename, fileobj) in files.items():
+            self.parts.append(self._header(name, filename) + b"Content-Type: application/octet-stream\r\n\r\n")
+            if isinstance(fileobj, (bytes, bytearray)):
+                self.parts.append(bytes(fileobj))
+            else:
+                position = fileobj.tell()
+                size = fileobj.seek(0, os.SEEK_END) - position
+                fileobj.seek(position)
+                self.parts.append((fileobj, size))
+            self.parts.append(b"\r\n")
+        self.parts.append(f"--{self.boundary}--\r\n".encode('utf-8'))
+        self.total = sum(part[1] if isinstance(part, tuple) else len(part) for part in self.parts)
+        self.sent = 0
+        self.reported = -1
+        self.index = 0
+        self.offset = 0
+
+    def __len__(self):
+        return self.total
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        chunks = []
+        remaining = min(size, self.chunk_size)
+        while remaining > 0 and self.index < len(self.parts):
+            part = self.parts[self.index]
+            if isinstance(part, tuple):
+                fileobj, part_size = part
+                chunk = fileobj.read(min(remaining, part_size - self.offset))
+                if not chunk and self.offset < part_size:
+                    raise Exception(f"File ended {part_size - self.offset} bytes early")
+            else:
+                part_size = len(part)
+                chunk = part[self.offset:self.offset + remaining]
+            chunks.append(chunk)
+            self.offset += len(chunk)
+            remaining -= len(chunk)
+            if self.offset >= part_size:
+                self.index += 1
+                self.offset = 0
+        data = b"".join(chunks)
+        self.sent += len(data)
+        self._report()
+        return data
+
+    def _header(self, name, filename=None):
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        return f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\n".encode('utf-8')
+
+    def _report(self):
+        if self.progress is None or self.total == 0:
+            return
+        percent = self.sent * 100 // self.total
+        if percent != self.reported:
+            self.reported = percent
+            try:
+                self.progress(self.sent, self.total)
+            except Exception as e:
+                logger.warning(f"upload progress callback error, {e}")
@@ -1,8 +1,10 @@
 from loguru import logger
 import base64
-import streamlit as st
+import hashlib
 from sqlalchemy import text
 from modules import AppStatus
+from modules.thumbnails import put_thumbnails
+from modules.storage import connect_db
 
 """
 my_apps table
@@ -16,76 +18,86 @@ my_apps table
     status TEXT
     created_at TEXT
     updated_at TEXT
+    image_hash TEXT
+    sync_hash TEXT
+    username TEXT
 """
 
+# fields of a comfyflow.app app that are synced to my_apps
+SYNC_FIELDS = ('name', 'description', 'image', 'template')
+
+
+def get_sync_hash(app):
+    # hash of the synced fields, the image is hashed as received without decoding it
+    digest = hashlib.sha256()
+    for field in SYNC_FIELDS:
+        digest.update(str(app.get(field)).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
 class MyAppModel:
     def __init__(self) -> None:
-        self.db_conn = st.connection('comfyflow_db', type='sql')
+        # reads use sessions of the pool, writes go through the writer thread, tables are made by modules.migrations
+        self.db_conn, self.writer = connect_db('comfyflow_db')
         self.app_table_name = 'my_apps'
-        self._init_table()
         logger.debug(f"db_conn: {self.db_conn}, app_table_name: {self.app_table_name}")
 
     @property
     def session(self):
         return self.db_conn.session
     
-    def _init_table(self):
-        # Create a table if it doesn't exist.
-        with self.session as s:
-            sql = text(f'CREATE TABLE IF NOT EXISTS {self.app_table_name} (id TEXT PRIMARY KEY, name TEXT, description TEXT, image TEXT, app_conf TEXT, api_conf TEXT, template TEXT, url TEXT, status TEXT, created_at TEXT, updated_at TEXT);')
-            s.execute(sql)
+    def sync_apps(self, apps):
+        """
+        make the apps of comfyflow.app the published apps of my_apps, installed apps are kept as they are.
+        Apps are diffed by the hash of their synced fields, only new and changed apps are written and
+        have their image decoded, all in one transaction. return the names of the written apps.
+        """
+        remote_apps = {app['id']: (app, get_sync_hash(app)) for app in apps}
 
-            # create index on name
-            sql = text(f'CREATE INDEX IF NOT EXISTS {self.app_table_name}_name_index ON {self.app_table_name} (name);')
-            s.execute(sql)
-            s.commit()
-            logger.info(f"init app table {self.app_table_name} and index")
+        def sync(s):
+            sql = text(f'SELECT id, status, sync_hash FROM {self.app_table_name};')
+            local_apps = {app.id: app for app in s.execute(sql).fetchall()}
 
-    def sync_apps(self, apps):
-        
-        with self.session as s:
-            # reset local apps
-            sql = text(f'SELECT id, status FROM {self.app_table_name} where status!=:status order by id;')
-            local_apps = s.execute(sql, dict(status=AppStatus.INSTALLED.value)).fetchall()
-            delete_apps = []
-            for app in local_apps:
-                delete_apps.append(app.id)
-                self.delete_app_by_id(app.id)
+            # local apps not installed and gone from comfyflow.app
+            delete_apps = [app_id for app_id, app in local_apps.items()
+                           if app.status != AppStatus.INSTALLED.value and app_id not in remote_apps]
+            if delete_apps:
+                sql = text(f'DELETE FROM {self.app_table_name} WHERE id=:id;')
+                s.execute(sql, [dict(id=app_id) for app_id in delete_apps])
             logger.info(f"reset local apps, {delete_apps}")
 
-        # sync apps from comfyflow.app
-        with self.session as s:
-            sql = text(f'SELECT id, status FROM {self.app_table_name} order by id;')
-            local_apps = s.execute(sql).fetchall()
-            local_app_ids = {app.id: app for app in local_apps}
-            sync_apps = []
-            for app in apps:
-                # convert base64 image to bytes
-                base64_data = app['image'].split(',')[-1]
-                image_bytes = base64.b64decode(base64_data)
-
-                if app['id'] in local_app_ids:
-                    if local_app_ids[app['id']].status == AppStatus.PUBLISHED.value:
-                        # update app
-                        sql = text(f'UPDATE {self.app_table_name} SET name=:name, description=:description, image=:image, template=:template, status=:status, updated_at=datetime("now") WHERE id=:id;')
-                        s.execute(sql, dict(id=app['id'], name=app['name'], description=app['description'], image=image_bytes, template=app['template'], status=AppStatus.PUBLISHED.value))
-                        s.commit()
-                        sync_apps.append(app['name'])
-                        logger.info(f"update app {app['name']} to my apps")
-                else:
-                    # insert app
-                    sql = text(f'INSERT INTO {self.app_table_name} (id, name, description, image, template, status, created_at, updated_at) VALUES (:id, :name, :description, :image, :template, :status, datetime("now"), datetime("now") );')
-                    s.execute(sql, dict(id=app['id'], name=app['name'], description=app['description'], image=image_bytes, template=app['template'], status=AppStatus.PUBLISHED.value))
-                    s.commit()
-                    sync_apps.append(app['name'])
-                    logger.info(f"insert app {app['name']} my apps")
-            logger.info(f"sync apps from comfyflow.app, {sync_apps}")
-            return sync_apps
+            changed_apps = []
+            for app_id, (app, sync_hash) in remote_apps.items():
+                local_app = local_apps.get(app_id)
+                if local_app is not None:
+                    if local_app.status == AppStatus.INSTALLED.value:
+                        continue
+                    if local_app.status == AppStatus.PUBLISHED.value and local_app.sync_hash == sync_hash:
+                        continue
+                changed_apps.append((app, sync_hash))
+            if not changed_apps:
+                return []
+
+            # convert base64 images to bytes
+            images = [base64.b64decode(app['image'].split(',')[-1]) for app, _ in changed_apps]
+            image_hashes = put_thumbnails(s, images)
+            sql = text(f'''INSERT INTO {self.app_table_name} (id, name, description, image_hash, template, status, sync_hash, created_at, updated_at)
+                        VALUES (:id, :name, :description, :image_hash, :template, :status, :sync_hash, datetime("now"), datetime("now"))
+                        ON CONFLICT(id) DO UPDATE SET name=excluded.name, description=excluded.description, image_hash=excluded.image_hash,
+                        template=excluded.template, status=excluded.status, sync_hash=excluded.sync_hash, updated_at=excluded.updated_at;''')
+            s.execute(sql, [dict(id=app['id'], name=app['name'], description=app['description'], image_hash=image_hash,
+                                 template=app['template'], status=AppStatus.PUBLISHED.value, sync_hash=sync_hash)
+                            for (app, sync_hash), image_hash in zip(changed_apps, image_hashes)])
+            return [app['name'] for app, _ in changed_apps]
+
+        sync_apps = self.writer.transaction(sync)
+        logger.info(f"sync apps from comfyflow.app, {len(apps)} apps, {len(sync_apps)} written, {sync_apps}")
+        return sync_apps
 
     def get_all_apps(self):
         with self.session as s:
             logger.info("get apps from db")
-            sql = text(f'SELECT id, name, description, image, app_conf, api_conf, endpoint, template, url, status, username FROM {self.app_table_name} order by id desc;')
+            sql = text(f'SELECT id, name, description, image_hash, app_conf, api_conf, template, url, status, username FROM {self.app_table_name} order by id desc;')
             apps = s.execute(sql).fetchall()
             return apps
         
@@ -93,7 +105,7 @@ class MyAppModel:
         # get installed apps
         with self.session as s:
             logger.debug("get my apps from db")
-            sql = text(f'SELECT id, name, description, image, app_conf, api_conf, template, url, status, username FROM {self.app_table_name} WHERE status=:status order by id desc;')
+            sql = text(f'SELECT id, name, description, image_hash, app_conf, api_conf, template, url, status, username FROM {self.app_table_name} WHERE status=:status order by id desc;')
             apps = s.execute(sql, {'status': AppStatus.INSTALLED.value}).fetchall()
             return apps
 
@@ -112,38 +124,28 @@ class MyAppModel:
             return app
         
     def delete_app(self, name):
-        with self.session as s:
-            logger.info(f"delete app: {name}")
-            sql = text(f'DELETE FROM {self.app_table_name} WHERE name=:name;')
-            s.execute(sql, dict(name=name))
-            s.commit()
+        logger.info(f"delete app: {name}")
+        sql = text(f'DELETE FROM {self.app_table_name} WHERE name=:name;')
+        self.writer.execute(sql, dict(name=name))
 
     def delete_app_by_id(self, id):
-        with self.session as s:
-            logger.info(f"delete app: {id}")
-            sql = text(f'DELETE FROM {self.app_table_name} WHERE id=:id;')
-            s.execute(sql, dict(id=id))
-            s.commit()
+        logger.info(f"delete app: {id}")
+        sql = text(f'DELETE FROM {self.app_table_name} WHERE id=:id;')
+        self.writer.execute(sql, dict(id=id))
 
     def update_app_status(self, id, status):
-        with self.session as s:
-            logger.info(f"update app status: {id}, {status}")
-            sql = text(f'UPDATE {self.app_table_name} SET status=:status WHERE id=:id;')
-            s.execute(sql, dict(id=id, status=status))
-            s.commit()
+        logger.info(f"update app status: {id}, {status}")
+        sql = text(f'UPDATE {self.app_table_name} SET status=:status WHERE id=:id;')
+        self.writer.execute(sql, dict(id=id, status=status))
 
     def update_api_conf(self, id, api_conf):
-        with self.session as s:
-            logger.info(f"update app api_conf: {id}, {api_conf}")
-            sql = text(f'UPDATE {self.app_table_name} SET api_conf=:api_conf WHERE id=:id;')
-            s.execute(sql, dict(id=id, api_conf=api_conf))
-            s.commit()
+        logger.info(f"update app api_conf: {id}, {api_conf}")
+        sql = text(f'UPDATE {self.app_table_name} SET api_conf=:api_conf WHERE id=:id;')
+        self.writer.execute(sql, dict(id=id, api_conf=api_conf))
 
     def update_app_conf(self, id, app_conf):
-        with self.session as s:
-            logger.info(f"update app app_conf: {id}, {app_conf}")
-            sql = text(f'UPDATE {self.app_table_name} SET app_conf=:app_conf WHERE id=:id;')
-            s.execute(sql, dict(id=id, app_conf=app_conf))
-            s.commit()
+        logger.info(f"update app app_conf: {id}, {app_conf}")
+        sql = text(f'UPDATE {self.app_table_name} SET app_conf=:app_conf WHERE id=:id;')
+        self.writer.execute(sql, dict(id=id, app_conf=app_conf))
 
        
\ No newline at end of file
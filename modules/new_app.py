@@ -68,7 +68,6 @@ def parse_prompt(prompt_info, object_info_meta):
 
             is_output = object_info_meta[class_type]['output_node']
             if is_output:
-                # TODO: support multi output
                 if class_type in SUPPORTED_COMFYUI_CLASSTYPE_OUTPUT:
                     option_key = f"{node_id}{NODE_SEP}{class_type}"
                     if len(node_inputs) == 0:
@@ -215,12 +214,16 @@ def get_node_input_config(input_param, app_input_name, app_input_description):
     return node_id, param, input_config
 
 
-def get_node_output_config(output_param):
+def get_node_output_config(output_param, app_output_name, app_output_description):
     params_outputs = st.session_state.get('create_prompt_outputs', {})
     output_param_value = params_outputs[output_param]
     node_id, class_type, param = output_param_value.split(NODE_SEP)
     output_param_inputs = {
         "outputs": {
+            class_type: {
+                "name": app_output_name,
+                "help": app_output_description,
+            }
         }
     }
     return node_id, output_param_inputs
@@ -273,8 +276,29 @@ def gen_app_config():
             app_config['inputs'][node_id]['inputs'][param] = input_param3_inputs
 
         # parse output_param1
-        node_id, output_param1_inputs = get_node_output_config(output_param1)
+        output_param1_name = st.session_state['output_param1_name']
+        output_param1_desc = st.session_state['output_param1_desc']
+        node_id, output_param1_inputs = get_node_output_config(
+            output_param1, output_param1_name, output_param1_desc)
         app_config['outputs'][node_id] = output_param1_inputs
+
+        # parse output_param2
+        output_param2 = st.session_state['output_param2']
+        output_param2_name = st.session_state['output_param2_name']
+        output_param2_desc = st.session_state['output_param2_desc']
+        if output_param2:
+            node_id, output_param2_inputs = get_node_output_config(
+                output_param2, output_param2_name, output_param2_desc)
+            app_config['outputs'][node_id] = output_param2_inputs
+
+        # parse output_param3
+        output_param3 = st.session_state['output_param3']
+        output_param3_name = st.session_state['output_param3_name']
+        output_param3_desc = st.session_state['output_param3_desc']
+        if output_param3:
+            node_id, output_param3_inputs = get_node_output_config(
+                output_param3, output_param3_name, output_param3_desc)
+            app_config['outputs'][node_id] = output_param3_inputs
         return app_config
 
 
@@ -446,13 +470,13 @@ def edit_app_ui(app):
                         'name': param_name,
                         'help': param_help,
                     }
-                    input_params.append(param)
+                    output_params.append(param)
 
-            if len(output_params) > 0:
-                output_param_1 = output_params[0]
-                add_output_config_param(params_outputs_options, 1, output_param_1)
-            else:
-                add_output_config_param(params_outputs_options, 1, None)
+            for index in range(1, 4):
+                if len(output_params) >= index:
+                    add_output_config_param(params_outputs_options, index, output_params[index - 1])
+                else:
+                    add_output_config_param(params_outputs_options, index, None)
 
     with st.container():
         operation_row = row([0.15, 0.7, 0.15])
@@ -579,6 +603,8 @@ def new_app_ui():
             params_outputs_options = list(params_outputs.keys())
 
             add_output_config_param(params_outputs_options, 1, None)
+            add_output_config_param(params_outputs_options, 2, None)
+            add_output_config_param(params_outputs_options, 3, None)
             
     
     with st.container():
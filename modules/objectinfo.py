@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from loguru import logger
+
+
+class ObjectInfoCache:
+    """
+    comfyui /object_info persisted in a local sqlite file, one row per class type.
+
+    Lookups read a single class, the full document is only parsed by the background refresh,
+    which rewrites the classes whose content hash changed. The cache survives restarts and is
+    shared by every process started from the same directory.
+    """
+    def __init__(self, fetch_object_info, path='.cache/object_info.db', refresh_interval=60, memory_size=256) -> None:
+        # fetch_object_info() returns the parsed /object_info document
+        self.fetch_object_info = fetch_object_info
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.memory_size = memory_size
+        # class_type -> class json text, parsed on every lookup so callers may modify the result
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.refreshed_at = None
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS object_info (class_type TEXT PRIMARY KEY, hash TEXT, info TEXT);')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS object_info_meta (key TEXT PRIMARY KEY, value TEXT);')
+            self.conn.commit()
+
+        if self.get_meta('hash') is None:
+            # nothing on disk yet, the first lookup needs the document
+            self.refresh()
+        self.thread = threading.Thread(target=self._refresh_loop, name="comfy-object-info", daemon=True)
+        self.thread.start()
+
+    def __getitem__(self, class_type):
+        # under the lock, so a refresh can't interleave and leave a stale class in memory
+        with self.lock:
+            info = self.memory.get(class_type)
+            if info is not None:
+                # least recently used classes are evicted first
+                self.memory.move_to_end(class_type)
+            else:
+                row = self.conn.execute('SELECT info FROM object_info WHERE class_type=?;', (class_type,)).fetchone()
+                if row is None:
+                    raise KeyError(class_type)
+                info = row[0]
+                self.memory[class_type] = info
+                while len(self.memory) > self.memory_size:
+                    self.memory.popitem(last=False)
+        return json.loads(info)
+
+    def __contains__(self, class_type):
+        try:
+            self[class_type]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, class_type, default=None):
+        try:
+            return self[class_type]
+        except KeyError:
+            return default
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT class_type FROM object_info ORDER BY class_type;')]
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM object_info_meta WHERE key=?;', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def refresh(self):
+        object_info = self.fetch_object_info()
+        infos = {class_type: json.dumps(info, sort_keys=True) for class_type, info in object_info.items()}
+        hashes = {class_type: hashlib.sha256(info.encode('utf-8')).hexdigest() for class_type, info in infos.items()}
+        doc_hash = hashlib.sha256(''.join(f"{k}:{hashes[k]}" for k in sorted(hashes)).encode('utf-8')).hexdigest()
+        self.refreshed_at = time.time()
+        if doc_hash == self.get_meta('hash'):
+            logger.debug(f"object_info unchanged, {len(infos)} classes")
+            return False
+
+        with self.lock:
+            stored = dict(self.conn.execute('SELECT class_type, hash FROM object_info;').fetchall())
+            changed = [(class_type, hashes[class_type], infos[class_type]) for class_type in infos
+                       if stored.get(class_type) != hashes[class_type]]
+            removed = [(class_type,) for class_type in stored if class_type not in infos]
+            self.conn.executemany('INSERT OR REPLACE INTO object_info (class_type, hash, info) VALUES (?, ?, ?);', changed)
+            self.conn.executemany('DELETE FROM object_info WHERE class_type=?;', removed)
+            self.conn.execute('INSERT OR REPLACE INTO object_info_meta (key, value) VALUES (?, ?);', ('hash', doc_hash))
+            self.conn.commit()
+            for class_type, _, _ in changed:
+                self.memory.pop(class_type, None)
+            for class_type, in removed:
+                self.memory.pop(class_type, None)
+        logger.info(f"object_info changed, {len(changed)} classes updated, {len(removed)} removed")
+        return True
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"refresh object_info error, {e}")
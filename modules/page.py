@@ -142,4 +142,31 @@ def custom_text_area():
             </style>
         """
         # 将自定义CSS样式添加到Streamlit中
-    st.markdown(custom_css, unsafe_allow_html=True)
\ No newline at end of file
+    st.markdown(custom_css, unsafe_allow_html=True)
+
+def get_page_cursor(key):
+    # before_id of the listing page shown, the cursors of the visited pages are kept in the session
+    cursors = st.session_state.setdefault(f"{key}_cursors", [None])
+    return cursors[-1]
+
+def pagination_ui(key, apps, page_size):
+    """
+    previous and next buttons under a keyset paginated listing of page_size + 1 rows, return the rows to show
+    """
+    cursors = st.session_state.setdefault(f"{key}_cursors", [None])
+    has_next = len(apps) > page_size
+    apps = apps[:page_size]
+
+    def previous_page():
+        if len(cursors) > 1:
+            cursors.pop()
+
+    def next_page():
+        cursors.append(apps[-1].id)
+
+    if len(cursors) > 1 or has_next:
+        page_row = st.columns([1, 1, 8])
+        page_row[0].button("◀ Previous", key=f"{key}_previous", on_click=previous_page, disabled=len(cursors) <= 1)
+        page_row[1].button("Next ▶", key=f"{key}_next", on_click=next_page, disabled=not has_next)
+        page_row[2].markdown(f"Page {len(cursors)}")
+    return apps
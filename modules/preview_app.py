@@ -34,7 +34,8 @@ def preview_app_ui(app):
             st.stop()
         
         comfy_client = get_comfy_client()
-        comfyflow = Comfyflow(comfy_client=comfy_client, api_data=api_data, app_data=app_data)
+        comfyflow = Comfyflow(comfy_client=comfy_client, api_data=api_data, app_data=app_data,
+                              app_id=app.id, app_version=app.updated_at)
         comfyflow.create_ui()
         if status == AppStatus.CREATED.value:
             if f"{name}_previewed" in st.session_state:
@@ -73,5 +74,6 @@ def enter_app_ui(app):
         api_data = app.api_conf
         app_data = app.app_conf
         comfy_client = get_comfy_client()
-        comfyflow = Comfyflow(comfy_client=comfy_client, api_data=api_data, app_data=app_data)
+        comfyflow = Comfyflow(comfy_client=comfy_client, api_data=api_data, app_data=app_data,
+                              app_id=app.id, app_version=app.updated_at)
         comfyflow.create_ui(show_header=False)                                    
\ No newline at end of file
@@ -0,0 +1,65 @@
+import time
+import queue
+from enum import Enum
+from loguru import logger
+
+
+class ProgressStatus(Enum):
+    WAITING = "Waiting"
+    FINISHED = "Finished"
+    ERROR = "Error"
+    STALLED = "Stalled"
+    TIMEOUT = "Timeout"
+    PRODUCER_DEAD = "ProducerDead"
+
+
+class ProgressWatcher:
+    """
+    Consume the events of one prompt from its progress queue without blocking forever.
+
+    events() stops at the final `executing` event or an execution error, when no event arrived
+    for event_timeout seconds, when the whole prompt took longer than total_timeout seconds,
+    or when is_alive() reports the producer is gone, e.g. the websocket stayed disconnected.
+    status tells which one it was.
+    """
+    def __init__(self, progress_queue, event_timeout=120, total_timeout=600, is_alive=None, poll_interval=1.0) -> None:
+        self.progress_queue = progress_queue
+        self.event_timeout = event_timeout
+        self.total_timeout = total_timeout
+        self.is_alive = is_alive
+        self.poll_interval = poll_interval
+        self.status = ProgressStatus.WAITING
+
+    def events(self):
+        start = time.monotonic()
+        deadline = start + self.total_timeout
+        last_event_at = start
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                logger.warning(f"progress timeout, no result after {self.total_timeout}s")
+                self.status = ProgressStatus.TIMEOUT
+                return
+            try:
+                event = self.progress_queue.get(timeout=min(self.poll_interval, deadline - now))
+            except queue.Empty:
+                if self.is_alive is not None and not self.is_alive():
+                    logger.warning("progress producer is dead, stop waiting")
+                    self.status = ProgressStatus.PRODUCER_DEAD
+                    return
+                if time.monotonic() - last_event_at >= self.event_timeout:
+                    logger.warning(f"progress stalled, no event for {self.event_timeout}s")
+                    self.status = ProgressStatus.STALLED
+                    return
+                continue
+
+            last_event_at = time.monotonic()
+            yield event
+
+            event_type = event['type']
+            if event_type == 'executing' and event['data'] is None:
+                self.status = ProgressStatus.FINISHED
+                return
+            if event_type in ('execution_error', 'execution_interrupted'):
+                self.status = ProgressStatus.ERROR
+                return
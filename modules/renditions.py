@@ -0,0 +1,116 @@
+import io
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from loguru import logger
+
+# leading bytes of the image formats comfyui outputs
+IMAGE_SIGNATURES = (
+    (b'\x89PNG', 'png', 'image/png'),
+    (b'\xff\xd8', 'jpg', 'image/jpeg'),
+    (b'RIFF', 'webp', 'image/webp'),
+    (b'GIF8', 'gif', 'image/gif'),
+)
+
+# st.image re-encodes images wider than this, and any image not in its output_format, JPEG or PNG
+MAX_DISPLAY_WIDTH = 1460
+DISPLAY_FORMATS = ('JPEG', 'PNG')
+
+
+def guess_image_type(data):
+    # (extension, mime) of encoded image bytes
+    for signature, ext, mime in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return ext, mime
+    return 'png', 'image/png'
+
+
+class RenditionMaker:
+    """
+    Downscaled JPEG/PNG renditions of output images for display, the original is kept for download.
+
+    Renditions are made in a thread pool and stored on disk by the sha256 of the source and the
+    rendition settings, the least recently used files are removed above max_files. The source is used instead
+    when it already fits and has the rendition format but the rendition isn't smaller.
+
+    Sizes and formats are limited to what st.image passes through as is, display renditions with
+    st.image(..., output_format=maker.format) so they aren't encoded a second time.
+    """
+    def __init__(self, max_size=MAX_DISPLAY_WIDTH, format='JPEG', quality=85, workers=2, path='.cache/renditions', max_files=2000) -> None:
+        if max_size > MAX_DISPLAY_WIDTH:
+            logger.warning(f"rendition size {max_size} is over {MAX_DISPLAY_WIDTH}, st.image would resize it again, use {MAX_DISPLAY_WIDTH}")
+            max_size = MAX_DISPLAY_WIDTH
+        format = format.upper().replace('JPG', 'JPEG')
+        if format not in DISPLAY_FORMATS:
+            logger.warning(f"rendition format {format} is converted by st.image, use JPEG")
+            format = 'JPEG'
+        self.max_size = max_size
+        self.format = format
+        self.quality = quality
+        self.path = path
+        self.max_files = max_files
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="comfy-rendition")
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def render_all(self, images):
+        return list(self.executor.map(self.render, images))
+
+    def render(self, data):
+        ext = 'jpg' if self.format == 'JPEG' else self.format.lower()
+        digest = hashlib.sha256(data).hexdigest()
+        rendition_path = os.path.join(self.path, f"{digest}-{self.max_size}-{self.quality}.{ext}")
+        try:
+            with open(rendition_path, 'rb') as f:
+                rendition = f.read()
+            # a hit counts as use, _trim removes the least recently used first
+            os.utime(rendition_path)
+            return rendition
+        except OSError:
+            pass
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            # the source can be displayed as is if it fits and has the display format
+            displayable = image.format == self.format and max(image.size) <= self.max_size
+            image.thumbnail((self.max_size, self.max_size))
+            if self.format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            output = io.BytesIO()
+            image.save(output, format=self.format, quality=self.quality)
+            rendition = output.getvalue()
+        except Exception as e:
+            logger.warning(f"make rendition error, {e}")
+            return data
+        if displayable and len(rendition) >= len(data):
+            rendition = data
+
+        tmp_path = f"{rendition_path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(rendition)
+            os.replace(tmp_path, rendition_path)
+        except OSError as e:
+            logger.warning(f"save rendition error, {e}")
+        logger.debug(f"Rendition {digest}, {len(data)} to {len(rendition)} bytes")
+        self._trim()
+        return rendition
+
+    def _trim(self):
+        with self.lock:
+            names = os.listdir(self.path)
+            if len(names) <= self.max_files:
+                return
+            def modified_at(path):
+                try:
+                    return os.path.getmtime(path)
+                except OSError:
+                    return 0
+            paths = sorted((os.path.join(self.path, name) for name in names), key=modified_at)
+            for path in paths[:len(paths) - self.max_files]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,135 @@
+import os
+import json
+import hashlib
+import threading
+from loguru import logger
+
+
+def get_prompt_key(prompt, input_hashes=()):
+    # canonical prompt graph plus the content of the uploaded input files, which the prompt only names
+    canonical = json.dumps(prompt, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.sha256(canonical.encode('utf-8'))
+    for input_hash in sorted(input_hashes):
+        digest.update(input_hash.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of generated images on local disk.
+
+    An entry is a directory named by the prompt key holding the images of every output node and a meta.json.
+    Reading an entry touches meta.json, entries with the oldest mtime are evicted when the cache
+    grows over max_bytes. Only prompts whose outputs are all image bytes are cached, gifs and videos are
+    served by comfyui urls.
+    """
+    def __init__(self, path='.cache/results', max_bytes=1024*1024*1024) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        os.makedirs(path, exist_ok=True)
+        # key -> size of the entry on disk
+        self.sizes = {}
+        for key in os.listdir(path):
+            entry_path = os.path.join(path, key)
+            if os.path.isdir(entry_path) and not key.endswith('.tmp'):
+                self.sizes[key] = sum(os.path.getsize(os.path.join(entry_path, name)) for name in os.listdir(entry_path))
+        logger.info(f"Result cache {path}, {len(self.sizes)} entries, {sum(self.sizes.values())} bytes")
+
+    def get(self, key):
+        entry_path = os.path.join(self.path, key)
+        meta_path = os.path.join(entry_path, 'meta.json')
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            # node_id -> (type, [image bytes])
+            outputs = {}
+            for node in meta['outputs']:
+                images = []
+                for name in node['files']:
+                    with open(os.path.join(entry_path, name), 'rb') as f:
+                        images.append(f.read())
+                outputs[node['node_id']] = (node['type'], images)
+            os.utime(meta_path)
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        size = sum(len(image) for _, images in outputs.values() for image in images)
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += size
+        logger.info(f"Result cache hit {key}, {len(outputs)} outputs, {size} bytes, {self.stats()}")
+        return outputs
+
+    def put(self, key, outputs):
+        # outputs: node_id -> (type, [image bytes])
+        if not outputs or any(output_type != 'images' for output_type, _ in outputs.values()):
+            return
+        entry_path = os.path.join(self.path, key)
+        if os.path.isdir(entry_path):
+            return
+        tmp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(tmp_path, exist_ok=True)
+            nodes = []
+            for n, (node_id, (output_type, images)) in enumerate(outputs.items()):
+                files = []
+                for i, image in enumerate(images):
+                    name = f"{n}-{i}.bin"
+                    with open(os.path.join(tmp_path, name), 'wb') as f:
+                        f.write(image)
+                    files.append(name)
+                nodes.append({"node_id": node_id, "type": output_type, "files": files})
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump({"outputs": nodes}, f)
+            # another session may have stored the same key meanwhile
+            os.rename(tmp_path, entry_path)
+        except OSError as e:
+            logger.warning(f"Result cache put {key} error, {e}")
+            self._remove(tmp_path)
+            return
+
+        with self.lock:
+            self.sizes[key] = sum(len(image) for _, images in outputs.values() for image in images)
+        self._evict()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.sizes),
+                "bytes": sum(self.sizes.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "bytes_saved": self.bytes_saved,
+            }
+
+    def _evict(self):
+        with self.lock:
+            total = sum(self.sizes.values())
+            if total <= self.max_bytes:
+                return
+            def accessed_at(key):
+                try:
+                    return os.path.getmtime(os.path.join(self.path, key, 'meta.json'))
+                except OSError:
+                    return 0
+            for key in sorted(self.sizes, key=accessed_at):
+                if total <= self.max_bytes:
+                    break
+                total -= self.sizes.pop(key)
+                self._remove(os.path.join(self.path, key))
+                logger.debug(f"Result cache evict {key}")
+
+    def _remove(self, entry_path):
+        if not os.path.isdir(entry_path):
+            return
+        for name in os.listdir(entry_path):
+            os.remove(os.path.join(entry_path, name))
+        os.rmdir(entry_path)
@@ -0,0 +1,115 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from loguru import logger
+import streamlit as st
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from modules.migrations import migrate
+
+
+def tune_sqlite_engine(engine, busy_timeout=5000, synchronous='NORMAL'):
+    """
+    WAL journal, so readers don't block the writer, a busy timeout instead of failing at once with
+    "database is locked", and synchronous NORMAL which is safe with WAL. Set on every new connection.
+    """
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={synchronous}")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+        cursor.close()
+
+    # connections opened before the listener don't have the pragmas
+    engine.dispose()
+
+
+class SqliteWriter:
+    """
+    All writes to the database go through one thread, sqlite allows a single writer anyway and this
+    way sessions queue in process instead of retrying on the file lock.
+
+    Writes waiting in the queue are committed together, up to max_batch in one transaction. If the
+    transaction fails, its writes are run again one by one so only the failing write gets the error.
+    """
+    def __init__(self, engine, max_batch=64) -> None:
+        self.engine = engine
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.commits = 0
+        self.writes = 0
+        self.thread = threading.Thread(target=self._run, name="comfy-sqlite-writer", daemon=True)
+        self.thread.start()
+
+    def transaction(self, fn):
+        """
+        run fn(connection) in a transaction of the writer thread, return its result once committed
+        """
+        future = Future()
+        self.queue.put((fn, future))
+        return future.result()
+
+    def execute(self, sql, params=None):
+        # a single write statement, return the number of rows it changed
+        return self.transaction(lambda conn: conn.execute(sql, params or {}).rowcount)
+
+    def _run(self):
+        while True:
+            jobs = [self.queue.get()]
+            while len(jobs) < self.max_batch:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                results = self._commit(jobs)
+            except Exception as e:
+                if len(jobs) == 1:
+                    jobs[0][1].set_exception(e)
+                    continue
+                logger.warning(f"sqlite batch of {len(jobs)} writes error, {e}, run them one by one")
+                for job in jobs:
+                    try:
+                        job[1].set_result(self._commit([job])[0])
+                    except Exception as e:
+                        job[1].set_exception(e)
+                continue
+            for (_, future), result in zip(jobs, results):
+                future.set_result(result)
+
+    def _commit(self, jobs):
+        with self.engine.begin() as conn:
+            results = [fn(conn) for fn, _ in jobs]
+        self.commits += 1
+        self.writes += len(jobs)
+        return results
+
+
+_lock = threading.Lock()
+
+
+def connect_db(name='comfyflow_db'):
+    """
+    st.connection of the app database with a pool of connections, the sqlite pragmas set and the
+    schema migrated, and the writer of its engine, shared by the models
+    """
+    pool_size = int(os.getenv('COMFYFLOW_DB_POOL_SIZE', 5))
+    db_conn = st.connection(name, type='sql', poolclass=QueuePool, pool_size=pool_size,
+                            max_overflow=pool_size * 2,
+                            connect_args={'check_same_thread': False})
+    engine = db_conn.engine
+    with _lock:
+        writer = getattr(engine, 'comfyflow_writer', None)
+        if writer is None:
+            busy_timeout = int(os.getenv('COMFYFLOW_DB_BUSY_TIMEOUT', 5000))
+            synchronous = os.getenv('COMFYFLOW_DB_SYNCHRONOUS', 'NORMAL')
+            tune_sqlite_engine(engine, busy_timeout=busy_timeout, synchronous=synchronous)
+            writer = SqliteWriter(engine)
+            logger.info(f"db {name}, pool size {pool_size}, busy timeout {busy_timeout}ms, synchronous {synchronous}")
+            # once per engine, instead of create and alter tables in every model
+            migrate(writer)
+            engine.comfyflow_writer = writer
+    return db_conn, writer
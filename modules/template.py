@@ -0,0 +1,89 @@
+import json
+import random
+import threading
+from collections import OrderedDict
+from loguru import logger
+
+# int inputs randomized on every run unless the app exposes them
+SEED_INPUTS = ('seed', 'noise_seed')
+
+
+class PromptTemplate:
+    """
+    The prompt of an app compiled once, with the patch points found ahead of time: seed slots to
+    randomize and the param slots of the app inputs.
+
+    render() copies the prompt dict, and only the nodes and inputs dicts of patched nodes, then writes
+    the slots. Untouched nodes are shared with the template and must not be modified by callers.
+    """
+    def __init__(self, api_data, app_data) -> None:
+        self.api_data = api_data
+        self.app_data = app_data
+        self.api_json = json.loads(api_data)
+        self.app_json = json.loads(app_data)
+
+        # (node_id, param_item) of the app inputs
+        self.param_slots = [(node_id, param_item) for node_id in self.app_json['inputs']
+                            for param_item in self.app_json['inputs'][node_id]['inputs']
+                            if node_id in self.api_json]
+        exposed = set(self.param_slots)
+        # (node_id, input name) of int seeds the app doesn't expose
+        self.seed_slots = [(node_id, param_name) for node_id, node in self.api_json.items()
+                           for param_name, param_value in node['inputs'].items()
+                           if param_name in SEED_INPUTS and isinstance(param_value, int)
+                           and (node_id, param_name) not in exposed]
+        self.patched_nodes = {node_id for node_id, _ in self.param_slots + self.seed_slots}
+
+    def render(self, params):
+        """
+        params: {node_id: {param_item: value}}
+        return: the prompt with random seeds and the params written
+        """
+        prompt = dict(self.api_json)
+        for node_id in self.patched_nodes:
+            node = dict(prompt[node_id])
+            node['inputs'] = dict(node['inputs'])
+            prompt[node_id] = node
+
+        for node_id, param_name in self.seed_slots:
+            random_value = random.randint(0, 0x7fffffffffffffff)
+            prompt[node_id]['inputs'][param_name] = random_value
+            logger.info(f"update prompt with random, {node_id} {param_name} to {random_value}")
+
+        for node_id, node_params in params.items():
+            if node_id not in self.patched_nodes:
+                # not an input of the app, copy before writing
+                prompt[node_id] = dict(prompt[node_id], inputs=dict(prompt[node_id]['inputs']))
+            for param_item, param_value in node_params.items():
+                prompt[node_id]['inputs'][param_item] = param_value
+        return prompt
+
+
+class TemplateCache:
+    """
+    Compiled templates by app id and version, the least recently used are dropped above max_size.
+    A hit is checked against the conf strings, versions of apps edited within a second may collide.
+    """
+    def __init__(self, max_size=64) -> None:
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # (app_id, version) -> PromptTemplate
+        self.templates = OrderedDict()
+
+    def get(self, app_id, version, api_data, app_data):
+        key = (str(app_id), version)
+        with self.lock:
+            template = self.templates.get(key)
+            if template is not None and template.api_data == api_data and template.app_data == app_data:
+                self.templates.move_to_end(key)
+                return template
+
+        template = PromptTemplate(api_data, app_data)
+        logger.debug(f"compile prompt template of app {app_id} {version}, {len(template.seed_slots)} seed slots, "
+                     f"{len(template.param_slots)} param slots")
+        with self.lock:
+            self.templates[key] = template
+            self.templates.move_to_end(key)
+            while len(self.templates) > self.max_size:
+                self.templates.popitem(last=False)
+        return template
@@ -0,0 +1,75 @@
+import os
+import hashlib
+import threading
+from sqlalchemy import text
+from loguru import logger
+
+# served by streamlit static serving from the static folder next to Home.py
+THUMBNAIL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'thumbnails')
+THUMBNAIL_URL = 'app/static/thumbnails'
+# app icons by sha256, shared by comfyflow_apps and my_apps
+THUMBNAIL_TABLE = 'app_thumbnails'
+
+
+def get_image_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def init_thumbnail_table(s):
+    sql = text(f'CREATE TABLE IF NOT EXISTS {THUMBNAIL_TABLE} (hash TEXT PRIMARY KEY, image BLOB);')
+    s.execute(sql)
+
+
+def put_thumbnail(s, image):
+    # store the icon in the session s, return its hash
+    return put_thumbnails(s, [image])[0]
+
+
+def put_thumbnails(s, images):
+    # store the icons with one executemany, return their hashes
+    image_hashes = [get_image_hash(image) for image in images]
+    if images:
+        sql = text(f'INSERT OR IGNORE INTO {THUMBNAIL_TABLE} (hash, image) VALUES (:hash, :image);')
+        s.execute(sql, [dict(hash=image_hash, image=image) for image_hash, image in zip(image_hashes, images)])
+    return image_hashes
+
+
+class ThumbnailStore:
+    """
+    App icons as files named by their sha256, so browsers cache them across page renders instead of
+    receiving the bytes again on every rerun. The database keeps the icons, files missing on disk are
+    written back from it on first use.
+
+    Urls carry the hash as version, streamlit's static file handler answers them with an ETag and a
+    long max-age.
+    """
+    def __init__(self, path=THUMBNAIL_DIR, url_path=THUMBNAIL_URL) -> None:
+        self.path = path
+        self.url_path = url_path
+        os.makedirs(path, exist_ok=True)
+
+    def file_path(self, image_hash):
+        return os.path.join(self.path, f"{image_hash}.png")
+
+    def save(self, image_hash, data):
+        file_path = self.file_path(image_hash)
+        if os.path.exists(file_path):
+            return
+        tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            logger.warning(f"save thumbnail {image_hash} error, {e}")
+
+    def url(self, image_hash, load=None):
+        """
+        url of the icon, load(image_hash) returns its bytes when the file isn't on disk yet
+        """
+        if not os.path.exists(self.file_path(image_hash)):
+            data = load(image_hash) if load else None
+            if data is None:
+                return None
+            self.save(image_hash, data)
+        return f"{self.url_path}/{image_hash}.png?v={image_hash[:12]}"
@@ -0,0 +1,87 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from loguru import logger
+
+
+class UploadManager:
+    """
+    Upload input files to comfyui once per content and backend.
+
+    A file is stored under a name derived from its sha256, so sessions uploading different files
+    with the same name don't overwrite each other, and a file already on a backend isn't sent again
+    when the page reruns. Streamlit gives every selected file a new file_id, the digest is computed
+    once per file_id.
+
+    An upload is trusted for ttl seconds, after that the file is sent again, in case the backend
+    was restarted or its input folder cleaned meanwhile.
+    """
+    def __init__(self, max_entries=10000, ttl=3600) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # file_id -> sha256 of the file content
+        self.digests = OrderedDict()
+        # (server_addr, subfolder, type, filename) of files known to be on a backend -> uploaded at
+        self.uploaded = OrderedDict()
+        self.lock = threading.Lock()
+        self.skipped = 0
+        self.uploads = 0
+
+    def digest(self, uploaded_file):
+        file_id = getattr(uploaded_file, 'file_id', None)
+        with self.lock:
+            digest = self.digests.get(file_id) if file_id is not None else None
+        if digest is None:
+            digest = self._hash(uploaded_file)
+            if file_id is not None:
+                with self.lock:
+                    self._remember(self.digests, file_id, digest)
+        return digest
+
+    def filename(self, uploaded_file):
+        _, ext = os.path.splitext(uploaded_file.name)
+        return f"{self.digest(uploaded_file)[:32]}{ext.lower()}"
+
+    def upload(self, comfy_client, uploaded_file, subfolder='', type='input', progress=None):
+        # returns the file name to put in the prompt
+        filename = self.filename(uploaded_file)
+        key = (comfy_client.server_addr, subfolder, type, filename)
+        with self.lock:
+            uploaded_at = self.uploaded.get(key)
+            if uploaded_at is not None and time.monotonic() - uploaded_at < self.ttl:
+                self.uploaded.move_to_end(key)
+                self.skipped += 1
+                return filename
+
+        uploaded_file.seek(0)
+        imagefile = {'image': (filename, uploaded_file)}
+        # same name means same content, overwriting is harmless
+        resp = comfy_client.upload_image(imagefile, subfolder, type, 'true', progress=progress)
+        uploaded_file.seek(0)
+        filename = resp.get('name', filename)
+        logger.info(f"Uploaded {uploaded_file.name} as {filename} to {comfy_client.server_addr}")
+        with self.lock:
+            self._remember(self.uploaded, key, time.monotonic())
+            self.uploads += 1
+        return filename
+
+    def stats(self):
+        with self.lock:
+            return {"uploads": self.uploads, "skipped": self.skipped, "files": len(self.uploaded)}
+
+    def _hash(self, uploaded_file, chunk_size=1024*1024):
+        # in chunks, the file is not copied as a whole
+        sha256 = hashlib.sha256()
+        uploaded_file.seek(0)
+        for chunk in iter(lambda: uploaded_file.read(chunk_size), b''):
+            sha256.update(chunk)
+        uploaded_file.seek(0)
+        return sha256.hexdigest()
+
+    def _remember(self, entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
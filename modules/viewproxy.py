@@ -0,0 +1,113 @@
+import json
+import threading
+import urllib.parse as urlparse
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from loguru import logger
+
+# response headers passed through from comfyui
+PROXY_HEADERS = ('Content-Type', 'Content-Length', 'Content-Disposition', 'Cache-Control', 'ETag', 'Last-Modified')
+# answered on /health, tells another process the port is held by a view proxy
+PROXY_SERVICE = 'comfyflow-view-proxy'
+
+
+class ViewProxyHandler(BaseHTTPRequestHandler):
+    # /view/<backend index>?filename=...&subfolder=...&type=...
+    def do_GET(self):
+        proxy = self.server.proxy
+        url = urlparse.urlsplit(self.path)
+        if url.path == '/health':
+            body = json.dumps(proxy.health()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'view' or not parts[1].isdigit() or int(parts[1]) >= len(proxy.backends()):
+            self.send_error(404)
+            return
+
+        query = urlparse.parse_qs(url.query)
+        params = {key: query.get(key, [''])[0] for key in ('filename', 'subfolder', 'type')}
+        comfy_client = proxy.backends()[int(parts[1])].comfy_client
+        try:
+            resp = comfy_client.session.get(f"{comfy_client.server_addr}/view", params=params, stream=True,
+                                            timeout=comfy_client.timeout)
+        except Exception as e:
+            logger.warning(f"View proxy error, {comfy_client.server_addr}, {e}")
+            self.send_error(502)
+            return
+
+        with resp:
+            self.send_response(resp.status_code)
+            for header in PROXY_HEADERS:
+                if header in resp.headers:
+                    self.send_header(header, resp.headers[header])
+            self.end_headers()
+            try:
+                for chunk in resp.iter_content(chunk_size=proxy.chunk_size):
+                    self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                logger.debug(f"View proxy client went away, {params}")
+
+    def log_message(self, format, *args):
+        logger.debug(f"View proxy {self.address_string()} {format % args}")
+
+
+class ViewProxy:
+    """
+    Stream comfyui /view responses to the browser, for deployments where comfyui isn't reachable
+    from outside. The image bytes pass through in chunks and are never held by the streamlit process.
+
+    Several ComfyFlowApp processes on one host share the proxy of the first one, they index the
+    backends of the same COMFYUI_SERVER_ADDR list. A busy port is only reused when its /health
+    answers as a proxy of the same backends, otherwise urls point to comfyui directly.
+    """
+    def __init__(self, backend_pool, host='0.0.0.0', port=8190, public_url=None, chunk_size=64*1024) -> None:
+        self.backend_pool = backend_pool
+        self.chunk_size = chunk_size
+        self.public_url = (public_url or f"http://localhost:{port}").rstrip('/')
+        self.server = None
+        # comfyui urls instead of proxy urls, no usable proxy on the port
+        self.direct = False
+        try:
+            self.server = ThreadingHTTPServer((host, port), ViewProxyHandler)
+        except OSError as e:
+            self.direct = not self.probe(host, port)
+            if self.direct:
+                logger.error(f"View proxy port {port} in use, {e}, and not by a proxy of these backends, serve comfyui urls directly")
+            else:
+                logger.info(f"View proxy port {port} in use, {e}, use the running proxy")
+            return
+        self.server.daemon_threads = True
+        self.server.proxy = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name="comfy-view-proxy", daemon=True)
+        self.thread.start()
+        logger.info(f"View proxy listening on {host}:{port}, public url {self.public_url}")
+
+    def backends(self):
+        return self.backend_pool.backends
+
+    def health(self):
+        return {"service": PROXY_SERVICE, "backends": [backend.server_addr for backend in self.backends()]}
+
+    def probe(self, host, port, timeout=2):
+        # True if a view proxy of the same backends listens on the port
+        probe_host = '127.0.0.1' if host in ('0.0.0.0', '') else host
+        try:
+            resp = requests.get(f"http://{probe_host}:{port}/health", timeout=timeout)
+            return resp.status_code == 200 and resp.json() == self.health()
+        except (requests.RequestException, ValueError) as e:
+            logger.debug(f"View proxy probe {probe_host}:{port} error, {e}")
+            return False
+
+    def get_image_url(self, comfy_client, filename, subfolder, folder_type):
+        if self.direct:
+            return comfy_client.get_image_url(filename, subfolder, folder_type)
+        for index, backend in enumerate(self.backends()):
+            if backend.comfy_client is comfy_client:
+                query = urlparse.urlencode({"filename": filename, "subfolder": subfolder, "type": folder_type})
+                return f"{self.public_url}/view/{index}?{query}"
+        raise Exception(f"Unknown comfyui backend, {comfy_client.server_addr}")
@@ -1,7 +1,8 @@
 from loguru import logger
-import streamlit as st
 from sqlalchemy import text
 from modules import AppStatus
+from modules.thumbnails import THUMBNAIL_TABLE, put_thumbnail
+from modules.storage import connect_db
 
 """
 comfyflow_apps table
@@ -16,57 +17,58 @@ comfyflow_apps table
     status TEXT
     created_at TEXT
     updated_at TEXT
+    username TEXT
+    workflow_conf TEXT
+    image_hash TEXT
+
+app_thumbnails table, app icons by sha256
+    hash TEXT
+    image BLOB
 """
 
+# app columns with the icon joined from app_thumbnails
+APP_COLUMNS = 'a.id, a.name, a.description, COALESCE(t.image, a.image) AS image, a.app_conf, a.api_conf, a.template, a.url, a.status, a.created_at, a.updated_at, a.username, a.workflow_conf, a.image_hash'
+
 class WorkspaceModel:
     def __init__(self) -> None:
-        self.db_conn = st.connection('comfyflow_db', type='sql')
+        # reads use sessions of the pool, writes go through the writer thread, tables are made by modules.migrations
+        self.db_conn, self.writer = connect_db('comfyflow_db')
         self.app_talbe_name = 'comfyflow_apps'
-        self._init_table()
+        self.thumbnail_table_name = THUMBNAIL_TABLE
         logger.info(f"db_conn: {self.db_conn}, app_talbe_name: {self.app_talbe_name}")
 
     @property
     def session(self):
         return self.db_conn.session
     
-    def _init_table(self):
-        # Create a table if it doesn't exist.
-        with self.session as s:
-            sql = text(f'CREATE TABLE IF NOT EXISTS {self.app_talbe_name} (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, description TEXT, image TEXT, app_conf TEXT, api_conf TEXT, template TEXT, url TEXT, status TEXT, created_at TEXT, updated_at TEXT);')
-            s.execute(sql)
-
-            # alert table: add username column
-            try:
-                s.execute(f'ALTER TABLE {self.app_talbe_name} ADD COLUMN username TEXT;' )
-            except:
-                columns = s.execute("PRAGMA table_info(asin)").fetchall()
-                logger.info(f"{self.app_talbe_name} columns: {columns}")
-            # alert table: add workflow_conf column
-            try:
-                s.execute(f'ALTER TABLE {self.app_talbe_name} ADD COLUMN workflow_conf TEXT;' )
-            except:
-                columns = s.execute("PRAGMA table_info(asin)").fetchall()
-                logger.info(f"{self.app_talbe_name} columns: {columns}")
-            
-
-            # create index on name
-            sql = text(f'CREATE INDEX IF NOT EXISTS {self.app_talbe_name}_name_index ON {self.app_talbe_name} (name);')
-            s.execute(sql)
-
-            s.commit()
-            logger.info(f"init app table {self.app_talbe_name} and index")
-
     def get_all_apps(self):
         with self.session as s:
             logger.info("get apps from db")
-            sql = text(f'SELECT id, name, description, image, app_conf, api_conf, workflow_conf, template, url, status, username FROM {self.app_talbe_name} order by id desc;')
+            sql = text(f'SELECT {APP_COLUMNS} FROM {self.app_talbe_name} a LEFT JOIN {self.thumbnail_table_name} t ON t.hash=a.image_hash order by a.id desc;')
             apps = s.execute(sql).fetchall()
             return apps
         
+    def list_apps(self, status=None, before_id=None, limit=20):
+        """
+        summary columns of one page of apps, newest first, without the app, api and workflow confs.
+        before_id is the smallest id of the previous page, a page has limit + 1 rows when more follow.
+        """
+        with self.session as s:
+            logger.info(f"list apps from db, status {status}, before {before_id}")
+            conditions = []
+            if status is not None:
+                conditions.append('status=:status')
+            if before_id is not None:
+                conditions.append('id<:before_id')
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+            sql = text(f'SELECT id, name, description, image_hash, template, url, status, username, updated_at, workflow_conf IS NOT NULL AS has_workflow FROM {self.app_talbe_name} {where} order by id desc LIMIT :limit;')
+            apps = s.execute(sql, {'status': status, 'before_id': before_id, 'limit': limit + 1}).fetchall()
+            return apps
+
     def get_installed_apps(self):
         with self.session as s:
             logger.info("get installed apps from db")
-            sql = text(f'SELECT id, name, description, image, app_conf, api_conf, workflow_conf, template, url, status, username FROM {self.app_talbe_name} WHERE status=:status order by id desc;')
+            sql = text(f'SELECT {APP_COLUMNS} FROM {self.app_talbe_name} a LEFT JOIN {self.thumbnail_table_name} t ON t.hash=a.image_hash WHERE a.status=:status order by a.id desc;')
             apps = s.execute(sql, {'status': AppStatus.INSTALLED.value}).fetchall()
             return apps
         
@@ -74,77 +76,75 @@ class WorkspaceModel:
     def get_app(self, name):
         with self.session as s:
             logger.info(f"get app by name: {name}")
-            sql = text(f'SELECT * FROM {self.app_talbe_name} WHERE name=:name;')
+            sql = text(f'SELECT {APP_COLUMNS} FROM {self.app_talbe_name} a LEFT JOIN {self.thumbnail_table_name} t ON t.hash=a.image_hash WHERE a.name=:name;')
             app = s.execute(sql, {'name': name}).fetchone()
             return app
         
     def get_app_by_id(self, id):
         with self.session as s:
             logger.info(f"get app by id: {id}")
-            sql = text(f'SELECT * FROM {self.app_talbe_name} WHERE id=:id;')
+            sql = text(f'SELECT {APP_COLUMNS} FROM {self.app_talbe_name} a LEFT JOIN {self.thumbnail_table_name} t ON t.hash=a.image_hash WHERE a.id=:id;')
             app = s.execute(sql, {'id': id}).fetchone()
             return app
         
     def create_app(self, app):
+        app['status'] = AppStatus.CREATED.value
+        logger.info(f"insert app: {app['name']} {app['description']}")
+
+        def insert_app(s):
+            # the icon is kept in app_thumbnails, the app row only refers to it
+            image = app.get('image')
+            image_hash = put_thumbnail(s, image) if image else None
+
+            sql = text(f'INSERT INTO {self.app_talbe_name} (username, name, description, image_hash, template, app_conf, api_conf, workflow_conf, status, created_at) VALUES (:username, :name, :description, :image_hash, :template, :app_conf, :api_conf, :workflow_conf, :status, datetime("now"));')
+            s.execute(sql, dict(app, image_hash=image_hash))
+
+        self.writer.transaction(insert_app)
+
+    def get_thumbnail(self, image_hash):
         with self.session as s:
-            app['status'] = AppStatus.CREATED.value
-            logger.info(f"insert app: {app['name']} {app['description']}")
-            
-            sql = text(f'INSERT INTO {self.app_talbe_name} (username, name, description, image, template, app_conf, api_conf, workflow_conf, status, created_at) VALUES (:username, :name, :description, :image, :template, :app_conf, :api_conf, :workflow_conf, :status, datetime("now"));')
-            s.execute(sql, app)
-            s.commit()
+            logger.debug(f"get thumbnail: {image_hash}")
+            sql = text(f'SELECT image FROM {self.thumbnail_table_name} WHERE hash=:hash;')
+            thumbnail = s.execute(sql, {'hash': image_hash}).fetchone()
+            return thumbnail.image if thumbnail else None
 
     def edit_app(self, id, name, description, app_conf):
         # update name, description, app_conf, could not update image, api_conf
-        with self.session as s:
-            logger.info(f"update app conf: {id} {name} {description} {app_conf}")
+        logger.info(f"update app conf: {id} {name} {description} {app_conf}")
             
-            sql = text(f'UPDATE {self.app_talbe_name} SET name=:name, description=:description, app_conf=:app_conf, updated_at=datetime("now") WHERE id=:id;')
-            s.execute(sql, dict(id=id, name=name, description=description, app_conf=app_conf))
-            s.commit()
+        sql = text(f'UPDATE {self.app_talbe_name} SET name=:name, description=:description, app_conf=:app_conf, updated_at=datetime("now") WHERE id=:id;')
+        self.writer.execute(sql, dict(id=id, name=name, description=description, app_conf=app_conf))
 
     def update_app_preview(self, name):
         # update preview_image
-        with self.session as s:
-            logger.info(f"update app preview: {name}")
-            sql = text(f'UPDATE {self.app_talbe_name} SET status=:status, updated_at=datetime("now") WHERE name=:name;')
-            s.execute(sql, dict(status=AppStatus.PREVIEWED.value, name=name))
-            s.commit()
+        logger.info(f"update app preview: {name}")
+        sql = text(f'UPDATE {self.app_talbe_name} SET status=:status, updated_at=datetime("now") WHERE name=:name;')
+        self.writer.execute(sql, dict(status=AppStatus.PREVIEWED.value, name=name))
     
     def update_app_publish(self, name, app_conf):
         # update publish
-        with self.session as s:
-            logger.info(f"update app publish: {name} {app_conf}")
-            sql = text(f'UPDATE {self.app_talbe_name} SET app_conf=:app_conf, status=:status, updated_at=datetime("now") WHERE name=:name;')
-            s.execute(sql, dict(app_conf=app_conf, status=AppStatus.PUBLISHED.value, name=name))
-            s.commit()
+        logger.info(f"update app publish: {name} {app_conf}")
+        sql = text(f'UPDATE {self.app_talbe_name} SET app_conf=:app_conf, status=:status, updated_at=datetime("now") WHERE name=:name;')
+        self.writer.execute(sql, dict(app_conf=app_conf, status=AppStatus.PUBLISHED.value, name=name))
 
     def update_app_install(self, name):
         # update install
-        with self.session as s:
-            logger.info(f"update app install: {name}")
-            sql = text(f'UPDATE {self.app_talbe_name} SET status=:status, updated_at=datetime("now") WHERE name=:name;')
-            s.execute(sql, dict(status=AppStatus.INSTALLED.value, name=name))
-            s.commit()
+        logger.info(f"update app install: {name}")
+        sql = text(f'UPDATE {self.app_talbe_name} SET status=:status, updated_at=datetime("now") WHERE name=:name;')
+        self.writer.execute(sql, dict(status=AppStatus.INSTALLED.value, name=name))
 
     def update_app_uninstall(self, name):
         # update uninstall
-        with self.session as s:
-            logger.info(f"update app uninstall: {name}")
-            sql = text(f'UPDATE {self.app_talbe_name} SET status=:status, updated_at=datetime("now") WHERE name=:name;')
-            s.execute(sql, dict(status=AppStatus.UNINSTALLED.value, name=name))
-            s.commit()
+        logger.info(f"update app uninstall: {name}")
+        sql = text(f'UPDATE {self.app_talbe_name} SET status=:status, updated_at=datetime("now") WHERE name=:name;')
+        self.writer.execute(sql, dict(status=AppStatus.UNINSTALLED.value, name=name))
 
     def delete_app(self, name):
-        with self.session as s:
-            logger.info(f"delete app: {name}")
-            sql = text(f'DELETE FROM {self.app_talbe_name} WHERE name=:name;')
-            s.execute(sql, dict(name=name))
-            s.commit()
+        logger.info(f"delete app: {name}")
+        sql = text(f'DELETE FROM {self.app_talbe_name} WHERE name=:name;')
+        self.writer.execute(sql, dict(name=name))
 
     def update_app_url(self, name, url):
-        with self.session as s:
-            logger.info(f"update app url: {name} {url}")
-            sql = text(f'UPDATE {self.app_talbe_name} SET url=:url, updated_at=datetime("now") WHERE name=:name;')
-            s.execute(sql, dict(url=url, name=name))
-            s.commit()      
\ No newline at end of file
+        logger.info(f"update app url: {name} {url}")
+        sql = text(f'UPDATE {self.app_talbe_name} SET url=:url, updated_at=datetime("now") WHERE name=:name;')
+        self.writer.execute(sql, dict(url=url, name=name))
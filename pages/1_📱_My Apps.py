@@ -5,9 +5,12 @@ from modules import get_workspace_model
 import modules.page as page
 from streamlit_extras.row import row
 from streamlit_extras.switch_page_button import switch_page
-from modules import AppStatus, check_comfyui_alive
+from modules import AppStatus, check_comfyui_alive, get_app_thumbnail_url
 from modules.preview_app import enter_app_ui
 
+# apps listed on one page
+MY_APPS_PAGE_SIZE = int(os.getenv('COMFYFLOW_PAGE_SIZE', 20))
+
 def uninstall_app(app):
     logger.info(f"uninstall app {app.name}")
     get_workspace_model().update_app_uninstall(app.name)
@@ -15,14 +18,17 @@ def uninstall_app(app):
 
 def enter_app(app):
     logger.info(f"enter app {app.name}")
-    st.session_state["enter_app"] = app
+    # listing rows hold no confs, load the whole app
+    st.session_state["enter_app"] = get_workspace_model().get_app_by_id(app.id)
 
 
 def create_app_info_ui(app):
     app_row = row([1, 5.4, 1.2, 1.4, 1], vertical_align="bottom")
     try:
-        if app.image is not None:
-            app_row.image(app.image)
+        # the icon is loaded by the browser from a static url, and cached there
+        image_url = get_app_thumbnail_url(app)
+        if image_url is not None:
+            app_row.markdown(f'<img src="{image_url}" style="width:100%">', unsafe_allow_html=True)
         else:
             app_row.image("public/images/app-150.png")
     except Exception as e:
@@ -73,8 +79,10 @@ with st.container():
                 switch_page("Workspace")
 
         with st.container():
-            apps = get_workspace_model().get_installed_apps()
-            if len(apps) == 0:
+            before_id = page.get_page_cursor('my_apps')
+            apps = get_workspace_model().list_apps(status=AppStatus.INSTALLED.value, before_id=before_id, limit=MY_APPS_PAGE_SIZE)
+            apps = page.pagination_ui('my_apps', apps, MY_APPS_PAGE_SIZE)
+            if len(apps) == 0 and before_id is None:
                 st.divider()
                 st.info("No apps, you could create and install app from your workspace")
             else:
@@ -4,7 +4,7 @@ from io import BytesIO
 from loguru import logger
 import streamlit as st
 import modules.page as page
-from modules import get_workspace_model, check_comfyui_alive, get_comfyflow_token
+from modules import get_workspace_model, check_comfyui_alive, get_comfyflow_token, get_app_thumbnail_url
 from streamlit_extras.row import row
 from manager.app_manager import start_app, stop_app
 from modules.workspace_model import AppStatus
@@ -14,13 +14,16 @@ from modules.preview_app import preview_app_ui
 from modules.publish_app import publish_app_ui
 import random
 
+# apps listed on one page
+WORKSPACE_PAGE_SIZE = int(os.getenv('COMFYFLOW_PAGE_SIZE', 20))
 
 def create_app_info_ui(app):
     app_row = row([1, 4.6, 1.2, 2, 1.2], vertical_align="bottom")
     try:
-        if app.image is not None:
-            
-            app_row.image(BytesIO(app.image))
+        # the icon is loaded by the browser from a static url, and cached there
+        image_url = get_app_thumbnail_url(app)
+        if image_url is not None:
+            app_row.markdown(f'<img src="{image_url}" style="width:100%">', unsafe_allow_html=True)
         else:
             app_row.image("./public/images/app-150.png")
     except Exception as e:
@@ -58,14 +61,15 @@ def click_new_app():
 
 def click_edit_app(app):
     logger.info(f"edit app: {app.name}")
-    st.session_state['edit_app'] = app
+    # listing rows hold no confs, load the whole app
+    st.session_state['edit_app'] = get_workspace_model().get_app_by_id(app.id)
     st.session_state.pop('new_app', None)
     st.session_state.pop('preview_app', None)
     st.session_state.pop('publish_app', None)
 
 def click_preview_app(app):    
     logger.info(f"preview app: {app.name}")
-    st.session_state['preview_app'] = app
+    st.session_state['preview_app'] = get_workspace_model().get_app_by_id(app.id)
     st.session_state.pop('new_app', None)
     st.session_state.pop('edit_app', None)
     st.session_state.pop('publish_app', None)
@@ -77,11 +81,15 @@ def click_publish_app(app):
         return
 
     logger.info(f"publish app: {app.name} status: {app.status}")
-    st.session_state['publish_app'] = app
+    st.session_state['publish_app'] = get_workspace_model().get_app_by_id(app.id)
     st.session_state.pop('new_app', None)
     st.session_state.pop('preview_app', None)
     
 
+def click_export_app(id):
+    logger.info(f"export app: {id}")
+    st.session_state['export_app_id'] = id
+
 def click_delete_app(name):
     logger.info(f"delete app: {name}")
     get_workspace_model().delete_app(name)
@@ -176,9 +184,14 @@ def create_operation_ui(app):
         if app_preview_ret == AppStatus.ERROR.value:
             st.error(f"Edit app {name} failed, please check the log")
 
-    if app.workflow_conf is not None:
-        operate_row.download_button("💾 Export", data=app.workflow_conf, file_name=f"{app.name}_workflow.json", help="Export workflow to json", key=f"{id}-button-export",
+    if app.has_workflow and st.session_state.get('export_app_id') == id:
+        # the workflow is loaded only for the app being exported
+        workflow_conf = get_workspace_model().get_app_by_id(id).workflow_conf
+        operate_row.download_button("💾 Download", data=workflow_conf, file_name=f"{app.name}_workflow.json", help="Download workflow json", key=f"{id}-button-download",
                         disabled=disabled)
+    elif app.has_workflow:
+        operate_row.button("💾 Export", help="Export workflow to json", key=f"{id}-button-export",
+                           on_click=click_export_app, args=(id,), disabled=disabled)
     else:
         operate_row.button("💾 Export", help="Export workflow to json", key=f"{id}-button-export", disabled=True)        
 
@@ -288,8 +301,10 @@ with st.container():
                 st.warning("Please go to homepage for your login :point_left:")
            
         with st.container():
-            apps = get_workspace_model().get_all_apps()
-            if len(apps) == 0:
+            before_id = page.get_page_cursor('workspace')
+            apps = get_workspace_model().list_apps(before_id=before_id, limit=WORKSPACE_PAGE_SIZE)
+            apps = page.pagination_ui('workspace', apps, WORKSPACE_PAGE_SIZE)
+            if len(apps) == 0 and before_id is None:
                 st.divider()
                 st.info("No apps, please create a new app.")
             else:
@@ -0,0 +1,31 @@
+import queue
+from modules.comfyws import EventDispatcher
+
+
+def test_subscribe_after_finished_prompt_replays_and_drops_subscription():
+    dispatcher = EventDispatcher()
+    dispatcher.dispatch({'type': 'execution_start', 'data': {'prompt_id': 'p'}, 'prompt_id': 'p'})
+    dispatcher.dispatch({'type': 'executing', 'data': None, 'prompt_id': 'p'})
+
+    progress_queue = queue.Queue()
+    dispatcher.subscribe('p', progress_queue)
+
+    assert [progress_queue.get_nowait()['type'] for _ in range(2)] == ['execution_start', 'executing']
+    assert dispatcher.stats()['subscribers'] == 0
+    assert 'p' not in dispatcher.preview_sent_at
+
+    # later status broadcasts don't reach the finished prompt
+    dispatcher.dispatch({'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': 0}}}})
+    assert progress_queue.empty()
+
+
+def test_subscribe_before_finish_keeps_subscription():
+    dispatcher = EventDispatcher()
+    dispatcher.dispatch({'type': 'execution_start', 'data': {'prompt_id': 'p'}, 'prompt_id': 'p'})
+
+    progress_queue = queue.Queue()
+    dispatcher.subscribe('p', progress_queue)
+    assert dispatcher.stats()['subscribers'] == 1
+
+    dispatcher.dispatch({'type': 'executing', 'data': None, 'prompt_id': 'p'})
+    assert dispatcher.stats()['subscribers'] == 0